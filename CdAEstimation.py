@@ -1,50 +1,58 @@
 import argparse
-import copy
+import multiprocessing
+import os
+import sys
 
 import matplotlib.pyplot as plt
 import numpy
 
-from lib import FitReader, ParamReader, Simulation
+from lib import ArrayCache, DragRegression, FitReader, ParamReader, Simulation
+
+
+def get_cholesky(cov: numpy.ndarray):
+    # Lower cholesky factor of the covariance, if the covariance is not positive definite (numerically) it is first
+    # projected onto the positive definite matrices by clipping the eigenvalues
+    cov = (cov + cov.T) / 2
+    try:
+        return numpy.linalg.cholesky(cov)
+    except numpy.linalg.LinAlgError:
+        eigenvalues, eigenvectors = numpy.linalg.eigh(cov)
+        eigenvalues = numpy.maximum(eigenvalues, max(eigenvalues.max(), 1) * 1e-9)
+        return numpy.linalg.cholesky((eigenvectors * eigenvalues) @ eigenvectors.T)
 
 
 def get_sigma_points(x: numpy.ndarray, cov: numpy.ndarray, kappa=None):
+    # Returns the 2n+1 sigma points as rows of a matrix and their weights
     if kappa is None:
         kappa = 3 - x.size
 
-    sigma_pts = []
-    sigma_weights = []
-
-    sigma_pts.append(x)
-    sigma_weights.append(kappa / (x.size + kappa))
+    chol = get_cholesky(cov) * numpy.sqrt(x.size + kappa)
+    sigma_pts = numpy.concatenate([x[None, :], x + chol.T, x - chol.T])
 
-    chol = numpy.linalg.cholesky(cov)
-    for c in range(x.size):
-        dir_vec = chol[c]
-        sigma_pts.append(x + dir_vec)
-        sigma_pts.append(x - dir_vec)
-        weights = 1 / (2 * (x.size + kappa))
-        sigma_weights.append(weights)
-        sigma_weights.append(weights)
+    sigma_weights = numpy.full(2 * x.size + 1, 1 / (2 * (x.size + kappa)))
+    sigma_weights[0] = kappa / (x.size + kappa)
 
     return sigma_pts, sigma_weights
 
 
-def get_mean_cov_from_sigma_pts(pts: list, weights: list):
-    mean = numpy.zeros(pts[0].shape)
-    for pt, weight in zip(pts, weights):
-        mean += pt * weight
-
-    cov = numpy.zeros((pts[0].size, pts[0].size))
-    for pt, weight in zip(pts, weights):
-        diff = pt - mean
-        cov += weight * numpy.outer(diff, diff)
+def get_mean_cov_from_sigma_pts(pts: numpy.ndarray, weights: numpy.ndarray):
+    mean = weights @ pts
+    diff = pts - mean
+    cov = diff.T @ (weights[:, None] * diff)
 
     return mean, cov
 
 
-def simultaneous_state_paramter_estimation(ds: list, delta_hs: list, Psis: list, Ps: list, ts: list, params,
-                                           init_cda=None, init_crr=None):
-    vs = [d / t for d, t in zip(ds, ts)]
+def simultaneous_state_paramter_estimation(ds, delta_hs, Psis, Ps, ts, params, init_cda=None, init_crr=None):
+    # Unscented Kalman filter over the velocity model, all sigma points are propagated at once.
+    # Returns the filtered states (velocity, gradient, power, CdA, Crr) for every timestep, the final covariance and
+    # the normalized innovation squared of every timestep.
+    ds = numpy.asarray(ds, dtype=float)
+    delta_hs = numpy.asarray(delta_hs, dtype=float)
+    Psis = numpy.asarray(Psis, dtype=float)
+    Ps = numpy.asarray(Ps, dtype=float)
+    ts = numpy.asarray(ts, dtype=float)
+    vs = ds / ts
 
     if init_cda is None:
         init_cda = params["CdA"]
@@ -56,40 +64,19 @@ def simultaneous_state_paramter_estimation(ds: list, delta_hs: list, Psis: list,
     x0 = numpy.array([vs[0], delta_hs[0] / ds[0], Ps[0], init_cda, init_crr])
 
     def f(x, t):
-        v = x[0]
-        g = x[1]
-        P = x[2]
-        CdA = x[3]
-        Crr = x[4]
-        try:
-            new_params = copy.deepcopy(params)
-            new_params["CdA"] = CdA
-            new_params["Crr"] = Crr
-            new_vel = Simulation.Simulation.get_velocity(last_velocity=v, P=P, delta_h=ds[t] * g, d=ds[t], Psi=Psis[t],
-                                                         params=new_params)
-        except ValueError:
-            new_vel = 0
-
-        return numpy.array([
-            new_vel,
-            g,
-            P,
-            CdA,
-            Crr
-        ])
+        new_params = dict(params, CdA=x[:, 3], Crr=x[:, 4])
+        new_vel = Simulation.Simulation.get_velocities(x[:, 0], x[:, 2], d=ds[t], delta_h=ds[t] * x[:, 1],
+                                                       Psi=Psis[t], params=new_params)
+
+        new_x = x.copy()
+        new_x[:, 0] = numpy.where(numpy.isnan(new_vel), 0, new_vel)
+        return new_x
 
     def h(x):
-        v = x[0]
-        g = x[1]
-        P = x[2]
-        return numpy.array([
-            v,
-            g,
-            P
-        ])
-
-    d_average = sum(ds) / len(ds)
-    pwr_average = sum(Ps) / len(Ps)
+        return x[:, :3]
+
+    d_average = ds.mean()
+    pwr_average = Ps.mean()
 
     R = numpy.diagflat([2 * 3 / (1 ** 2), (0.2 / d_average) ** 2, (pwr_average * 0.01) ** 2])
     Q = numpy.diagflat([0.001, 0.2, 10, 0.1, 0.1])
@@ -97,76 +84,150 @@ def simultaneous_state_paramter_estimation(ds: list, delta_hs: list, Psis: list,
     x = x0
     P = numpy.identity(5)
 
-    xs = [x0]
+    xs = numpy.empty((len(ds), x0.size))
+    xs[0] = x0
 
-    nies_samples = []
+    nis_samples = numpy.empty(len(ds) - 1)
 
     for t in range(1, len(ds)):
         z = numpy.array([vs[t], delta_hs[t] / ds[t], Ps[t]])
 
         pred_x_pts, weights = get_sigma_points(x, P)
-        pred_x_pts = [f(x, t) for x in pred_x_pts]
-        pred_x, pred_cov = get_mean_cov_from_sigma_pts(pred_x_pts, weights)
+        pred_x, pred_cov = get_mean_cov_from_sigma_pts(f(pred_x_pts, t), weights)
         pred_cov += Q
 
         meas_x_pts, _ = get_sigma_points(pred_x, pred_cov)
-        meas_z_pts = [h(x) for x in meas_x_pts]
+        meas_z_pts = h(meas_x_pts)
         pred_z, pred_z_cov = get_mean_cov_from_sigma_pts(meas_z_pts, weights)
         pred_z_cov += R
 
-        correlation = numpy.zeros((pred_x.size, pred_z.size))
-        for weight, measXPt, measZPt in zip(weights, meas_x_pts, meas_z_pts):
-            correlation += weight * numpy.outer(measXPt - pred_x, measZPt - pred_z)
-
-        kalman_gain = correlation @ numpy.linalg.inv(pred_z_cov)
-
-        nies_samples.append((z - pred_z).transpose() @ numpy.linalg.inv(pred_z_cov) @ (z - pred_z))
-
-        x = pred_x + kalman_gain @ (z - pred_z)
-        P = pred_cov - kalman_gain @ pred_z_cov @ kalman_gain.transpose()
-
-        while not numpy.all(numpy.linalg.eigvals(P) > 0):
-            print("Hacky hack hack")
-            P += numpy.identity(P.shape[0]) * abs(numpy.linalg.det(P)) * 2
-
-        xs.append(x)
-
-    filtered_vs = [x[0] for x in xs]
-    filtered_delta_hs = [x[1] * ds[t] for t, x in enumerate(xs)]
-    filtered_Ps = [x[2] for x in xs]
-    CdAs = [x[3] for x in xs]
-    Crrs = [x[4] for x in xs]
-
-    plt.plot(vs, label="Measurement")
-    plt.plot(filtered_vs, label="Filtered")
-    plt.title("Velocity")
-    plt.legend()
-    plt.show()
-
-    plt.plot(Ps, label="Measurement")
-    plt.plot(filtered_Ps, label="Filtered")
-    plt.title("P")
-    plt.legend()
-    plt.show()
-
-    plt.plot(delta_hs, label="Measurement")
-    plt.plot(filtered_delta_hs, label="Filtered")
-    plt.title("delta_h")
-    plt.legend()
-    plt.show()
+        correlation = (meas_x_pts - pred_x).T @ (weights[:, None] * (meas_z_pts - pred_z))
+
+        # Solves with the cholesky factor of the innovation covariance instead of inverting it
+        chol = get_cholesky(pred_z_cov)
+        whitened = numpy.linalg.solve(chol, numpy.column_stack([correlation.T, z - pred_z]))
+        whitened_correlation = whitened[:, :-1]
+        whitened_innovation = whitened[:, -1]
+
+        nis_samples[t - 1] = whitened_innovation @ whitened_innovation
+
+        x = pred_x + whitened_correlation.T @ whitened_innovation
+        P = pred_cov - whitened_correlation.T @ whitened_correlation
+        P = (P + P.T) / 2
+
+        xs[t] = x
+
+    return xs, P, nis_samples
+
+
+def plot_estimation(ds, delta_hs, Ps, ts, xs, nis_samples, output_dir=None, name="estimation"):
+    # Shows the plots or, if output_dir is set, writes them (and the filtered states) to files
+    vs = numpy.asarray(ds) / numpy.asarray(ts)
+    plots = [
+        ("Velocity", vs, xs[:, 0]),
+        ("P", Ps, xs[:, 2]),
+        ("delta_h", delta_hs, xs[:, 1] * numpy.asarray(ds)),
+        ("CdA", None, xs[:, 3]),
+        ("Crr", None, xs[:, 4]),
+    ]
+
+    for title, measurement, filtered in plots:
+        fig, ax = plt.subplots()
+        if measurement is not None:
+            ax.plot(measurement, label="Measurement")
+            ax.plot(filtered, label="Filtered")
+            ax.legend()
+        else:
+            ax.plot(filtered)
+        ax.set_title(title)
+        if output_dir is not None:
+            fig.savefig(os.path.join(output_dir, f"{name}_{title}.png"))
+            plt.close(fig)
+
+    fig, ax = plt.subplots()
+    ax.hist(nis_samples)
+    ax.set_title("NIS")
+    if output_dir is not None:
+        fig.savefig(os.path.join(output_dir, f"{name}_NIS.png"))
+        plt.close(fig)
+
+        numpy.savetxt(os.path.join(output_dir, f"{name}.csv"), xs, delimiter=",",
+                      header="v,gradient,P,CdA,Crr", comments="")
+    else:
+        plt.show()
+
+
+def split_powered_segments(ds, delta_hs, Psis, Ps, ts, min_power=50, min_length=10):
+    # Splits an activity into the contiguous parts with a power above min_power, parts with at most min_length samples
+    # are dropped. Every part keeps its own headings.
+    powered = numpy.asarray(Ps) > min_power
+    edges = numpy.flatnonzero(numpy.diff(numpy.concatenate([[False], powered, [False]]).astype(int)))
+    columns = [numpy.asarray(column, dtype=float) for column in (ds, delta_hs, Psis, Ps, ts)]
+    return [tuple(column[begin:end] for column in columns)
+            for begin, end in zip(edges[::2], edges[1::2]) if end - begin > min_length]
+
+
+def fuse_estimates(estimates, covs):
+    # Fuses independent estimates by weighting them with their inverse covariance (information), the result does not
+    # depend on the order of the estimates. Returns the fused estimate and its covariance.
+    informations = numpy.linalg.inv(numpy.asarray(covs))
+    information = informations.sum(axis=0)
+    information_mean = numpy.einsum("kij,kj->i", informations, numpy.asarray(estimates))
+    cov = numpy.linalg.inv(information)
+    return cov @ information_mean, cov
+
+
+def _estimate_file(job):
+    # Runs in a worker process: reads the activity and filters every powered segment, all segments start from the
+    # values in the params file
+    file, params, use_cache = job
+    results = []
+    for ds, delta_hs, Psis, Ps, ts in split_powered_segments(*FitReader.read_fit(file, use_cache=use_cache)):
+        xs, P, nis_samples = simultaneous_state_paramter_estimation(ds, delta_hs, Psis, Ps, ts, params)
+        results.append((ds, delta_hs, Ps, ts, xs, P[3:, 3:], nis_samples))
+    return file, results
+
+
+def _accumulate_file(job):
+    # Runs in a worker process: reads the activity and computes the sufficient statistics of the least squares fit
+    file, file_hash, params, use_cache, robust = job
+    X, y = DragRegression.get_regression_data(*FitReader.read_fit(file, use_cache=use_cache), params)
+    statistics = DragRegression.get_statistics(X, y, robust=robust)
+    statistics.files[file_hash] = file
+    return statistics
+
+
+def estimate_least_squares(args, params):
+    # Files that are already part of the statistics (identified by their hash) are not read again
+    statistics = DragRegression.SufficientStatistics()
+    if args.statistics is not None and os.path.exists(args.statistics):
+        statistics = DragRegression.SufficientStatistics.load(args.statistics)
+
+    jobs = []
+    for file in args.files:
+        file_hash = ArrayCache.get_file_hash(file)
+        if file_hash in statistics.files or any(job[1] == file_hash for job in jobs):
+            print(f"Skipping {file}, already included")
+        else:
+            jobs.append((file, file_hash, params, args.use_cache, args.robust))
 
-    plt.plot(CdAs)
-    plt.title("CdA")
-    plt.show()
+    if jobs:
+        with multiprocessing.Pool(min(args.jobs or os.cpu_count(), len(jobs))) as pool:
+            for file_statistics in pool.imap_unordered(_accumulate_file, jobs):
+                statistics.merge(file_statistics)
 
-    plt.plot(Crrs)
-    plt.title("Crr")
-    plt.show()
+    if args.statistics is not None:
+        statistics.save(args.statistics)
 
-    plt.hist(nies_samples)
-    plt.show()
+    try:
+        (CdA, Crr), cov = statistics.solve()
+    except (ValueError, numpy.linalg.LinAlgError):
+        print("Not enough samples with power for the least squares fit!")
+        sys.exit(1)
 
-    return CdAs[-1], Crrs[-1]
+    print(f"Files:\t{len(statistics.files)} ({statistics.n} samples)\n"
+          f"CdA:\t{CdA} (std. dev. {numpy.sqrt(cov[0, 0]):.4f})\n"
+          f"Crr:\t{Crr} (std. dev. {numpy.sqrt(cov[1, 1]):.5f})")
 
 
 def main():
@@ -175,42 +236,54 @@ def main():
                         help="The fit files, needs to include distance, power and altitude")
     parser.add_argument("--params", dest="params", type=str, default="params.json",
                         help="Params file, the CdA in the file is used as initial estimate")
+    parser.add_argument("--no_cache", dest="use_cache", action="store_false",
+                        help="Do not read or write the parsed activities from/to a file next to the fit file")
+    parser.add_argument("--output_dir", dest="output_dir", type=str, default=None,
+                        help="Write the plots and filtered states to this directory instead of showing them")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=None,
+                        help="Number of worker processes, defaults to the number of cores")
+    parser.add_argument("--method", dest="method", type=str, choices=["ukf", "least_squares"], default="ukf",
+                        help="Estimate with an unscented Kalman filter or a least squares fit of the drag power")
+    parser.add_argument("--statistics", dest="statistics", type=str, default=None,
+                        help="least_squares: JSON file with the statistics of previous files, it is updated with "
+                             "the new files")
+    parser.add_argument("--robust", dest="robust", action="store_true",
+                        help="least_squares: reduce the weight of outliers (huber weights)")
     args = parser.parse_args()
 
     params = ParamReader.read_params(args.params)
 
-    segment_ds = []
-    segment_delta_hs = []
-    segment_Psis = []
-    segment_Ps = []
-    segment_ts = []
+    if args.method == "least_squares":
+        estimate_least_squares(args, params)
+        return
+
+    if args.output_dir is not None:
+        plt.switch_backend("Agg")
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    # Every file is estimated independently, the order of the results is restored by sorting
+    jobs = [(file, params, args.use_cache) for file in args.files]
+    with multiprocessing.Pool(min(args.jobs or os.cpu_count(), len(jobs))) as pool:
+        file_results = dict(pool.imap_unordered(_estimate_file, jobs))
 
+    estimates = []
+    covs = []
     for file in args.files:
-        ds, delta_hs, Psis, Ps, ts = FitReader.read_fit(file)
-        last_was_zero = True
-        for d, delta_h, Psi, P, t in zip(ds, delta_hs, Psis, Ps, ts):
-            if P > 50:
-                if last_was_zero:
-                    segment_ds.append([d])
-                    segment_delta_hs.append([delta_h])
-                    segment_Psis.append([Psi])
-                    segment_Ps.append([P])
-                    segment_ts.append([t])
-                else:
-                    segment_ds[-1].append(d)
-                    segment_delta_hs[-1].append(delta_h)
-                    segment_Psis[-1].append(Psi)
-                    segment_Ps[-1].append(P)
-                    segment_ts[-1].append(t)
-                last_was_zero = False
-            else:
-                last_was_zero = True
-
-    CdA = None
-    Crr = None
-    for ds, delta_hs, Ps, ts in zip(segment_ds, segment_delta_hs, segment_Ps, segment_ts):
-        if len(ds) > 10:
-            CdA, Crr = simultaneous_state_paramter_estimation(ds, delta_hs, Psis, Ps, ts, params, CdA, Crr)
+        for i, (ds, delta_hs, Ps, ts, xs, cov, nis_samples) in enumerate(file_results[file]):
+            estimates.append(xs[-1, 3:])
+            covs.append(cov)
+            name = f"{os.path.splitext(os.path.basename(file))[0]}_segment_{i}"
+            print(f"{name}:\tCdA {xs[-1, 3]:.4f}, Crr {xs[-1, 4]:.5f}")
+            plot_estimation(ds, delta_hs, Ps, ts, xs, nis_samples, output_dir=args.output_dir, name=name)
+
+    if not estimates:
+        print("No segment with enough power samples!")
+        sys.exit(1)
+
+    (CdA, Crr), cov = fuse_estimates(estimates, covs)
+    print(f"Segments:\t{len(estimates)}\n"
+          f"CdA:\t{CdA} (std. dev. {numpy.sqrt(cov[0, 0]):.4f})\n"
+          f"Crr:\t{Crr} (std. dev. {numpy.sqrt(cov[1, 1]):.5f})")
 
 
 if __name__ == "__main__":
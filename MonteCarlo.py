@@ -0,0 +1,151 @@
+import argparse
+import datetime
+import json
+import math
+import sys
+
+import numpy
+
+from lib import CoursePreparation, Simulation, ParamReader, TransitionTable
+
+# Fields of the params file that can be sampled, the wind fields are stored as "wind": {"direction", "speed"}
+SAMPLE_FIELDS = ["CdA", "Crr", "m", "wind_direction", "wind_speed", "temperature", "pressure"]
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def sample(distribution: str, num_samples: int, rng: numpy.random.Generator):
+    # distribution is one of normal:mean:std_dev, uniform:low:high, triangular:left:mode:right or a fixed number
+    name, *args = distribution.split(":")
+    args = [float(arg) for arg in args]
+    if name == "normal":
+        return rng.normal(*args, size=num_samples)
+    elif name == "uniform":
+        return rng.uniform(*args, size=num_samples)
+    elif name == "triangular":
+        return rng.triangular(*args, size=num_samples)
+    else:
+        return numpy.full(num_samples, float(distribution))
+
+
+def main():
+    parser = argparse.ArgumentParser("Estimate the distribution of the time for a course under parameter uncertainty")
+    parser.add_argument("course", type=str, help="The gpx/fit file of the course")
+    parser.add_argument("--params", dest="params", type=str, default="params.json",
+                        help="Params file, used for all fields that are not sampled")
+    for field in SAMPLE_FIELDS:
+        parser.add_argument(f"--{field}", dest=field, type=str, default=None,
+                            help=f"Distribution of {field}: normal:mean:std_dev, uniform:low:high, "
+                                 f"triangular:left:mode:right or a fixed value")
+    parser.add_argument("--samples", dest="samples", type=int, help="Number of samples", default=10000)
+    parser.add_argument("--seed", dest="seed", type=int, help="Seed of the random number generator", default=None)
+    parser.add_argument("--power", dest="power", type=float, help="Constant power (in Watts) for the course",
+                        default=300)
+    parser.add_argument("--plan", dest="plan", type=str, default=None,
+                        help="File with the power for every segment (e.g. from OptimalPacing.py --save_plan), "
+                             "replaces --power")
+    parser.add_argument("--output", dest="output", type=str, default=None,
+                        help="CSV file for the percentiles of the time of every segment")
+    parser.add_argument("--segment_len", dest="segment_len", type=float, help="Length of a segment over which constant"
+                                                                              "power is assumed", default=100)
+    parser.add_argument("--elevation_smooth_window", dest="elevation_smooth_window", type=float,
+                        help="Size of the window used for elevation smoothing", default=50)
+    parser.add_argument("--elevation_smooth_std_dev", dest="elevation_smooth_std_dev", type=float,
+                        help="Standard deviation of the kernel used for elevation smoothing", default=50)
+    parser.add_argument("--elevation_tolerance", dest="elevation_tolerance", type=float, default=None,
+                        help="Merge segments between changes of the gradient of the elevation profile simplified "
+                             "with this tolerance (in m)")
+    parser.add_argument("--gradient_tolerance", dest="gradient_tolerance", type=float, default=None,
+                        help="Changes of the gradient (in %%) of the simplified profile up to which segments are "
+                             "merged (default: none)")
+    parser.add_argument("--heading_tolerance", dest="heading_tolerance", type=float, default=None,
+                        help="Merge segments as long as the heading changes at most this much (in degrees)")
+    parser.add_argument("--max_segment_len", dest="max_segment_len", type=float, default=None,
+                        help="Maximum length (in m) of merged segments")
+    parser.add_argument("--initial_velocity", dest="init_vel", type=float,
+                        help="Initial velocity (in km/h), needs to be positive", default=30)
+    parser.add_argument("--solver", dest="solver", type=str,
+                        help="Solver to use for dynamics ODE", default="DISTANCE_RK45")
+    parser.add_argument("--distance_euler_step_size", dest="distance_euler_step_size", type=float,
+                        help="Step size for the DISTANCE_EULER solver", default=1)
+    parser.add_argument("--time_euler_step_size", dest="time_euler_step_size", type=float,
+                        help="Step size for the TIME_EULER solver", default=0.1)
+    parser.add_argument("--min_time_euler_step_size", dest="min_time_euler_step_size", type=float,
+                        help="Step size for the TIME_EULER solver at which to stop solving", default=0.01)
+    parser.add_argument("--rk_tolerance", dest="rk_tolerance", type=float,
+                        help="Tolerance for the velocity (in m/s) of every step of the DISTANCE_RK45 solver",
+                        default=0.001)
+    parser.add_argument("--no_cache", dest="use_cache", action="store_false",
+                        help="Do not read or write the preprocessed course from/to the cache")
+    parser.add_argument("--cache_dir", dest="cache_dir", type=str, help="Directory of the course cache", default=None)
+    args = parser.parse_args()
+
+    root = json.load(open(args.params, "r"))
+    if not args.course.endswith(CoursePreparation.SUPPORTED_FORMATS):
+        print("Unknown file format!")
+        sys.exit(1)
+    ds, delta_hs, Psis = CoursePreparation.prepare_course(args.course, segment_len=args.segment_len,
+                                                          elevation_smooth_window=args.elevation_smooth_window,
+                                                          elevation_smooth_std_dev=args.elevation_smooth_std_dev,
+                                                          elevation_tolerance=args.elevation_tolerance,
+                                                          gradient_tolerance=args.gradient_tolerance / 100
+                                                          if args.gradient_tolerance is not None else None,
+                                                          heading_tolerance=math.radians(args.heading_tolerance)
+                                                          if args.heading_tolerance is not None else None,
+                                                          max_segment_len=args.max_segment_len,
+                                                          use_cache=args.use_cache, cache_dir=args.cache_dir)
+
+    if args.plan is not None:
+        plan = numpy.loadtxt(args.plan, ndmin=1)
+        if len(plan) != len(ds):
+            print(f"The plan has {len(plan)} segments, the course {len(ds)}!")
+            sys.exit(1)
+    else:
+        plan = numpy.full(len(ds), args.power)
+
+    # All sampled values are arrays, the params are computed for all samples at once
+    rng = numpy.random.default_rng(args.seed)
+    for field in SAMPLE_FIELDS:
+        distribution = getattr(args, field)
+        if distribution is None:
+            continue
+        values = sample(distribution, args.samples, rng)
+        if field.startswith("wind_"):
+            root.setdefault("wind", {"direction": 0, "speed": 0})[field[len("wind_"):]] = values
+        else:
+            root[field] = values
+    params = ParamReader.get_params(root)
+
+    sim = Simulation.Simulation(ds, delta_hs, Psis)
+    sim_solver_params = {"distance_euler_step_size": args.distance_euler_step_size,
+                         "time_euler_step_size": args.time_euler_step_size,
+                         "min_time_euler_step_size": args.min_time_euler_step_size,
+                         "rk_tolerance": args.rk_tolerance}
+    sim_solver, sim_solver_params = TransitionTable.get_solver(Simulation.Solver[args.solver.upper()],
+                                                               sim_solver_params, params, ds,
+                                                               use_cache=args.use_cache, cache_dir=args.cache_dir)
+    _, _, ts, total_times, average_powers = sim.forward_batch(numpy.repeat(plan[None, :], args.samples, axis=0),
+                                                              params, initial_velocity=args.init_vel / 3.6,
+                                                              solver=sim_solver, solver_params=sim_solver_params)
+
+    print(f"Samples:\t\t{args.samples}\n"
+          f"Mean time:\t\t{datetime.timedelta(seconds=int(total_times.mean()))} "
+          f"(std. dev. {total_times.std():.0f}s)\n"
+          f"Avg. Power:\t\t{average_powers.mean():.0f}W")
+    for percentile, total_time in zip(PERCENTILES, numpy.percentile(total_times, PERCENTILES)):
+        print(f"P{percentile}:\t\t\t{datetime.timedelta(seconds=int(total_time))}")
+
+    segment_percentiles = numpy.percentile(ts, PERCENTILES, axis=0)
+    spread = segment_percentiles[-1] - segment_percentiles[0]
+    print(f"Largest spread:\t{spread.max():.1f}s (P{PERCENTILES[-1]} - P{PERCENTILES[0]}) at "
+          f"{(numpy.cumsum(ds)[spread.argmax()] - ds[spread.argmax()]) / 1000:.1f}km")
+
+    if args.output is not None:
+        header = ",".join(["distance", "mean", "std_dev"] + [f"p{percentile}" for percentile in PERCENTILES])
+        numpy.savetxt(args.output, numpy.column_stack([numpy.cumsum(ds) - ds, ts.mean(axis=0), ts.std(axis=0),
+                                                       *segment_percentiles]),
+                      delimiter=",", header=header, comments="")
+
+
+if __name__ == "__main__":
+    main()
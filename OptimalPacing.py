@@ -1,12 +1,11 @@
 import argparse
-import copy
 import datetime
 import math
 import sys
 
-import sympy
+import numpy
 
-from lib import GpxReader, FitReader, Simulation, ParamReader, RouteNormalization, ElevationSmoothing
+from lib import CoursePreparation, PacingOptimization, Simulation, ParamReader, TransitionTable
 
 
 def main():
@@ -20,10 +19,22 @@ def main():
                         default=700)
     parser.add_argument("--segment_len", dest="segment_len", type=float, help="Length of a segment over which constant"
                                                                               "power is assumed", default=100)
+    parser.add_argument("--circular_mean_heading", dest="circular_mean_heading", action="store_true",
+                        help="Use the distance weighted mean heading of a segment instead of the heading at its end")
     parser.add_argument("--elevation_smooth_window", dest="elevation_smooth_window", type=float,
                         help="Size of the window used for elevation smoothing", default=50)
     parser.add_argument("--elevation_smooth_std_dev", dest="elevation_smooth_std_dev", type=float,
                         help="Standard deviation of the kernel used for elevation smoothing", default=50)
+    parser.add_argument("--elevation_tolerance", dest="elevation_tolerance", type=float, default=None,
+                        help="Merge segments between changes of the gradient of the elevation profile simplified "
+                             "with this tolerance (in m)")
+    parser.add_argument("--gradient_tolerance", dest="gradient_tolerance", type=float, default=None,
+                        help="Changes of the gradient (in %%) of the simplified profile up to which segments are "
+                             "merged (default: none)")
+    parser.add_argument("--heading_tolerance", dest="heading_tolerance", type=float, default=None,
+                        help="Merge segments as long as the heading changes at most this much (in degrees)")
+    parser.add_argument("--max_segment_len", dest="max_segment_len", type=float, default=None,
+                        help="Maximum length (in m) of merged segments")
     parser.add_argument("--initial_velocity", dest="init_vel", type=float,
                         help="Initial velocity (in km/h), needs to be positive", default=30)
     parser.add_argument("--max_iterations", dest="max_iterations", type=int,
@@ -32,6 +43,36 @@ def main():
                         help="Maximum deviation from average to accept pacing strategy", default=5)
     parser.add_argument("--time_tolerance", dest="time_tolerance", type=float,
                         help="Improvement in time at which to stop optimization", default=0.5)
+    parser.add_argument("--optimizer", dest="optimizer", type=str,
+                        choices=["line_search", "SLSQP", "L-BFGS-B", "dynamic_programming"],
+                        help="Gradient descent with a line search, a quasi-Newton method (requires scipy) or dynamic "
+                             "programming", default="line_search")
+    parser.add_argument("--average_power_constraint", dest="average_power_constraint", type=str,
+                        choices=["equality", "inequality"], default="equality",
+                        help="SLSQP/L-BFGS-B: the average power equals or is at most --power")
+    parser.add_argument("--num_velocities", dest="num_velocities", type=int, default=100,
+                        help="dynamic_programming: number of velocities of the grid")
+    parser.add_argument("--num_powers", dest="num_powers", type=int, default=50,
+                        help="dynamic_programming: number of powers (between 0 and --max_power) of the grid")
+    parser.add_argument("--multigrid", dest="multigrid", type=float, default=None,
+                        help="Optimize on segments of this length (in m) first and refine the plan down to "
+                             "--segment_len (not for dynamic_programming)")
+    parser.add_argument("--horizon", dest="horizon", type=int, default=None,
+                        help="Receding horizon: optimize windows of this many segments instead of the whole course "
+                             "(not for dynamic_programming)")
+    parser.add_argument("--horizon_commit", dest="horizon_commit", type=int, default=None,
+                        help="receding horizon: number of segments that are committed per window (default: half of "
+                             "--horizon)")
+    parser.add_argument("--polish_iterations", dest="polish_iterations", type=int, default=10,
+                        help="multigrid/receding horizon/merged segments: maximum optimizer iterations on every "
+                             "level/window after the first")
+    parser.add_argument("--start_distance", dest="start_distance", type=float, default=0,
+                        help="Re-plan during a ride from this position (in km), --initial_velocity is the current "
+                             "speed")
+    parser.add_argument("--elapsed_time", dest="elapsed_time", type=float, default=0,
+                        help="Time (in s) ridden before --start_distance, for the average power")
+    parser.add_argument("--elapsed_work", dest="elapsed_work", type=float, default=0,
+                        help="Work (in kJ) done before --start_distance, for the average power")
     parser.add_argument("--solver", dest="solver", type=str,
                         help="Solver to use for dynamics ODE", default="DISTANCE_EULER")
     parser.add_argument("--distance_euler_step_size", dest="distance_euler_step_size", type=float,
@@ -40,132 +81,197 @@ def main():
                         help="Step size for the TIME_EULER solver", default=0.1)
     parser.add_argument("--min_time_euler_step_size", dest="min_time_euler_step_size", type=float,
                         help="Step size for the TIME_EULER solver at which to stop solving", default=0.01)
+    parser.add_argument("--rk_tolerance", dest="rk_tolerance", type=float,
+                        help="Tolerance for the velocity (in m/s) of every step of the DISTANCE_RK45 solver",
+                        default=0.001)
+    parser.add_argument("--save_plan", dest="save_plan", type=str, default=None,
+                        help="File to which the power of every segment is written (one per line)")
+    parser.add_argument("--no_cache", dest="use_cache", action="store_false",
+                        help="Do not read or write the preprocessed course from/to the cache")
+    parser.add_argument("--cache_dir", dest="cache_dir", type=str, help="Directory of the course cache", default=None)
 
     args = parser.parse_args()
 
     params = ParamReader.read_params(args.params)
-    if args.course.endswith(".gpx"):
-        ds, delta_hs, Psis = GpxReader.read_gpx(args.course)
-    elif args.course.endswith(".fit"):
-        ds, delta_hs, Psis, _, _ = FitReader.read_fit(args.course)
-    else:
+    if not args.course.endswith(CoursePreparation.SUPPORTED_FORMATS):
         print("Unknown file format!")
         sys.exit(1)
-    ds, delta_hs, Psis = RouteNormalization.normalize(ds, delta_hs, Psis, segment_len=args.segment_len)
-    ds, delta_hs, Psis = ElevationSmoothing.smooth_truncated_gaussian(ds, delta_hs, Psis,
-                                                                      width=args.elevation_smooth_window,
-                                                                      sigma=args.elevation_smooth_std_dev)
+    # Segments are merged if any of the limits but gradient_tolerance (which refines elevation_tolerance) is set
+    tolerances = (args.elevation_tolerance,
+                  args.gradient_tolerance / 100 if args.gradient_tolerance is not None else None,
+                  math.radians(args.heading_tolerance) if args.heading_tolerance is not None else None,
+                  args.max_segment_len)
+    simplify = args.elevation_tolerance is not None or args.heading_tolerance is not None \
+        or args.max_segment_len is not None
+
+    def prepare_course(segment_len, tolerances=tolerances):
+        elevation_tolerance, gradient_tolerance, heading_tolerance, max_segment_len = tolerances
+        return CoursePreparation.prepare_course(args.course, segment_len=segment_len,
+                                                elevation_smooth_window=args.elevation_smooth_window,
+                                                elevation_smooth_std_dev=args.elevation_smooth_std_dev,
+                                                circular_mean_heading=args.circular_mean_heading,
+                                                elevation_tolerance=elevation_tolerance,
+                                                gradient_tolerance=gradient_tolerance,
+                                                heading_tolerance=heading_tolerance, max_segment_len=max_segment_len,
+                                                use_cache=args.use_cache, cache_dir=args.cache_dir)
+
+    # The plan is always optimized on the normalized course, the merged segments are only used as a coarser level
+    ds, delta_hs, Psis = prepare_course(args.segment_len, tolerances=(None,) * 4)
+    if simplify:
+        merged_ds, merged_delta_hs, merged_Psis = prepare_course(args.segment_len)
 
     init_velocity = args.init_vel / 3.6
     assert init_velocity > 0
 
+    if args.optimizer == "dynamic_programming" and (args.multigrid is not None or args.horizon is not None or simplify):
+        print("The dynamic_programming optimizer can not be warm started, --multigrid, --horizon and merged segments "
+              "are not supported!")
+        sys.exit(1)
+    if args.multigrid is not None and (args.horizon is not None or args.start_distance > 0):
+        print("--multigrid can not be combined with --horizon or --start_distance!")
+        sys.exit(1)
+    if simplify and args.horizon is not None:
+        print("Merged segments can not be combined with --horizon!")
+        sys.exit(1)
+
     sim_solver = Simulation.Solver[args.solver.upper()]
     sim_solver_params = {"distance_euler_step_size": args.distance_euler_step_size,
                          "time_euler_step_size": args.time_euler_step_size,
-                         "min_time_euler_step_size": args.min_time_euler_step_size}
+                         "min_time_euler_step_size": args.min_time_euler_step_size,
+                         "rk_tolerance": args.rk_tolerance}
 
-    sim = Simulation.Simulation(ds, delta_hs, Psis)
-    sim.forward([args.power] * len(ds), initial_velocity=init_velocity, params=params, solver=sim_solver,
-                solver_params=sim_solver_params)
-    last_time = sim.get_total_time()
-    print(f"[Step 0]\tTotal time:\t\t{datetime.timedelta(seconds=int(last_time))}", end="")
-
-    # System description:
-    #   v_{t+1} = f(v_t, P_t)
-    # State cost = t = d/v_t, Control Cost = 0
-    v_t, P_t, d_t, delta_h_t, Psi_t = sympy.symbols("v_t, P_t, d_t, delta_h_t, Psi_t")
-    f = sim.get_velocity(last_velocity=v_t, P=P_t, d=d_t, delta_h=delta_h_t, Psi=Psi_t, params=params,
-                         solver=Simulation.Solver.DIRECT_SHOOTING)
-    a_t_sym = f.diff(v_t)
-    b_t_sym = f.diff(P_t)
-
-    state_cost_sym = d_t / v_t
-    q_t_sym = state_cost_sym.diff(v_t)
-
-    for c in range(args.max_iterations):
-        # Run once with direct shooting to have an appropriate over power for solver for step
-        if sim_solver != Simulation.Solver.DIRECT_SHOOTING:
-            sim.forward([args.power] * len(ds), initial_velocity=init_velocity, params=params,
-                        solver=Simulation.Solver.DIRECT_SHOOTING)
-
-        # Back pass
-        cost = float(q_t_sym.evalf(subs={
-            v_t: sim.vs[-1],
-            P_t: sim.Ps[-1],
-            d_t: ds[-1],
-            delta_h_t: delta_hs[-1],
-            Psi_t: Psis[-1]
-        }))
-        steps = [0] * len(ds)
-        for i in range(len(ds)):
-            t = len(ds) - i - 1
-
-            bindings = {
-                v_t: sim.vs[t],
-                P_t: sim.Ps[t],
-                d_t: ds[t],
-                delta_h_t: delta_hs[t],
-                Psi_t: Psis[t]
-            }
-
-            a_t = float(a_t_sym.evalf(subs=bindings))
-            b_t = float(b_t_sym.evalf(subs=bindings))
-            q_t = float(q_t_sym.evalf(subs=bindings))
-
-            steps[t] = -(cost * b_t)
-            cost = q_t + cost * a_t
-
-        # Line search
-        best_time = math.inf
-        old_Ps = copy.deepcopy(sim.Ps)
-        best_powers = None
-
-        for alpha_exp in range(-10, 6):
-            alpha = 10 ** alpha_exp
-
-            # Apply step
-            for t in range(len(ds)):
-                sim.Ps[t] = min(max(old_Ps[t] + alpha * steps[t], 0), args.max_power)
-
-            # Reforward to get average (depends on time for each segment)
-            sim.forward(sim.Ps, params, initial_velocity=init_velocity, solver=sim_solver,
-                        solver_params=sim_solver_params)
-
-            # Rescale average
-            power_scale = args.power / sim.get_average_power()
-            for t in range(len(ds)):
-                sim.Ps[t] *= power_scale
-
-            # Reforward to recompute velocity
-            sim.forward(sim.Ps, params, initial_velocity=init_velocity, solver=sim_solver,
-                        solver_params=sim_solver_params)
-
-            if sim.get_total_time() < best_time:
-                best_time = sim.get_total_time()
-                best_powers = copy.deepcopy(sim.Ps)
-
-        # Update internal state of sim...
-        sim.forward(copy.deepcopy(best_powers), params=params, solver=sim_solver, solver_params=sim_solver_params,
-                    initial_velocity=init_velocity)
-
-        if abs(sim.get_total_time() - last_time) < args.time_tolerance \
-                and sim.get_average_power() < args.power + args.power_tolerance:
-            break
+    sim_solver, sim_solver_params = TransitionTable.get_solver(sim_solver, sim_solver_params, params, ds,
+                                                               use_cache=args.use_cache, cache_dir=args.cache_dir)
+
+    if simplify:
+        # Error of the merged segments against the normalized course, for constant power over the whole course
+        uniform_sim = Simulation.Simulation(ds, delta_hs, Psis)
+        merged_sim = Simulation.Simulation(merged_ds, merged_delta_hs, merged_Psis)
+        for course_sim in (uniform_sim, merged_sim):
+            course_sim.forward([args.power] * len(course_sim.ds), params=params, initial_velocity=init_velocity,
+                               solver=sim_solver, solver_params=sim_solver_params)
+        print(f"Segments:\t\t{len(merged_ds)} merged instead of {len(ds)} "
+              f"({merged_sim.get_total_time() - uniform_sim.get_total_time():+.1f}s at {args.power:.0f}W)")
+
+    if args.start_distance > 0:
+        # The remaining course starts at the segment boundary closest to the current position, every boundary of a
+        # merged segment is a boundary of the normalized course
+        boundaries = numpy.concatenate([[0], numpy.cumsum(merged_ds if simplify else ds)])
+        start_distance = boundaries[numpy.argmin(numpy.abs(boundaries - args.start_distance * 1000))]
+        if start_distance >= boundaries[-1]:
+            print("The start distance is beyond the end of the course!")
+            sys.exit(1)
+        start = int(numpy.argmin(numpy.abs(numpy.concatenate([[0], numpy.cumsum(ds)]) - start_distance)))
+        ds, delta_hs, Psis = (numpy.asarray(values)[start:] for values in (ds, delta_hs, Psis))
+        if simplify:
+            merged_start = int(numpy.argmin(numpy.abs(boundaries - start_distance)))
+            merged_ds, merged_delta_hs, merged_Psis = (numpy.asarray(values)[merged_start:]
+                                                       for values in (merged_ds, merged_delta_hs, merged_Psis))
+
+    def print_step(iteration, total_time):
+        print(f"\r[Step {iteration}]\tTotal time:\t\t{datetime.timedelta(seconds=int(total_time))}", end="")
+
+    def optimize(sim, max_iterations, initial_Ps=None, average_power=args.power, initial_velocity=init_velocity,
+                 terminal_distance=None):
+        if args.optimizer == "line_search":
+            return PacingOptimization.optimize_line_search(
+                sim, params, average_power, args.max_power, initial_velocity, sim_solver, sim_solver_params,
+                max_iterations=max_iterations, power_tolerance=args.power_tolerance,
+                time_tolerance=args.time_tolerance, initial_Ps=initial_Ps, terminal_distance=terminal_distance,
+                callback=print_step)
+        elif args.optimizer == "dynamic_programming":
+            return PacingOptimization.optimize_dynamic_programming(
+                sim, params, average_power, args.max_power, initial_velocity, sim_solver, sim_solver_params,
+                max_iterations=max_iterations, power_tolerance=args.power_tolerance,
+                num_velocities=args.num_velocities, num_powers=args.num_powers, callback=print_step)
         else:
-            last_time = sim.get_total_time()
-            print(f"\r[Step {c + 1}]\tTotal time:\t\t{datetime.timedelta(seconds=int(last_time))}", end="")
+            try:
+                return PacingOptimization.optimize_quasi_newton(
+                    sim, params, average_power, args.max_power, initial_velocity, sim_solver, sim_solver_params,
+                    method=args.optimizer, max_iterations=max_iterations, power_tolerance=args.power_tolerance,
+                    time_tolerance=args.time_tolerance, equality=args.average_power_constraint == "equality",
+                    initial_Ps=initial_Ps, terminal_distance=terminal_distance, callback=print_step)
+            except ImportError:
+                print("The SLSQP and L-BFGS-B optimizers require scipy!")
+                sys.exit(1)
+
+    if args.horizon is not None:
+        sim = Simulation.Simulation(ds, delta_hs, Psis)
+
+        def print_window(segment, elapsed_time):
+            print(f"\r[Segment {segment}/{len(sim.ds)}]\t"
+                  f"Elapsed time:\t{datetime.timedelta(seconds=int(elapsed_time))}")
+
+        iterations, forward_passes = PacingOptimization.optimize_receding_horizon(
+            sim, params, args.power, args.max_power, init_velocity, sim_solver, sim_solver_params, optimize,
+            window=args.horizon, commit=args.horizon_commit, max_iterations=args.max_iterations,
+            polish_iterations=args.polish_iterations, elapsed_time=args.elapsed_time,
+            elapsed_work=args.elapsed_work * 1000, callback=print_window)
+    else:
+        average_power = args.power
+        if args.elapsed_time > 0:
+            # The remaining time at constant power estimates over how much time the work budget is spread
+            budget_sim = Simulation.Simulation(ds, delta_hs, Psis)
+            budget_sim.forward([args.power] * len(ds), params=params, initial_velocity=init_velocity,
+                               solver=sim_solver, solver_params=sim_solver_params)
+            average_power = PacingOptimization.get_budget_power(args.power, args.elapsed_time,
+                                                                args.elapsed_work * 1000, budget_sim.get_total_time())
+
+        # The coarse levels of the multigrid and the merged segments are optimized first, the finest level is the
+        # normalized course
+        courses = []
+        if args.multigrid is not None:
+            courses += [prepare_course(segment_len, tolerances=(None,) * 4)
+                        for segment_len in PacingOptimization.get_multigrid_segment_lens(args.multigrid,
+                                                                                         args.segment_len)[:-1]]
+        if simplify:
+            courses.append((merged_ds, merged_delta_hs, merged_Psis))
+        courses.append((ds, delta_hs, Psis))
+
+        def optimize_level(sim, max_iterations, initial_Ps=None):
+            return optimize(sim, max_iterations, initial_Ps, average_power=average_power)
+
+        def print_level(level, sim):
+            print(f"\r[Level {level + 1}/{len(courses)}]\t{len(sim.ds)} segments, "
+                  f"total time: {datetime.timedelta(seconds=int(sim.get_total_time()))}")
+
+        if len(courses) == 1:
+            sim = Simulation.Simulation(ds, delta_hs, Psis)
+            iterations, forward_passes = optimize_level(sim, args.max_iterations)
+        else:
+            sim, iterations, forward_passes = PacingOptimization.optimize_multigrid(
+                courses, optimize_level, max_iterations=args.max_iterations,
+                polish_iterations=min(args.polish_iterations, args.max_iterations), callback=print_level)
+    last_time = sim.get_total_time()
 
     print(
         f"\rTotal time:\t\t{datetime.timedelta(seconds=int(last_time))}\n"
         f"Total distance:\t{sim.get_total_distance() / 1000:.3f}km\n"
         f"Avg. Speed:\t\t{sim.get_average_speed() * 3.6:.1f}km/h\n"
         f"Work:\t\t\t{sim.get_total_work() / 1000:.0f}kJ ({sim.get_average_power():.0f}W Avg)\n"
-        f"Vertical:\t\t+{sim.get_vertical_meters()[0]:.0f}m, -{sim.get_vertical_meters()[1]:.0f}m")
+        f"Vertical:\t\t+{sim.get_vertical_meters()[0]:.0f}m, -{sim.get_vertical_meters()[1]:.0f}m\n"
+        f"Optimizer:\t\t{iterations} iterations, {forward_passes} forward passes\n"
+        f"Solver:\t\t\t{sum(sim.evaluations) / len(sim.ds):.1f} model evaluations per segment")
+    if args.start_distance > 0 or args.elapsed_time > 0:
+        finish_time = args.elapsed_time + last_time
+        print(f"Finish time:\t\t{datetime.timedelta(seconds=int(finish_time))} "
+              f"({(args.elapsed_work * 1000 + sim.get_total_work()) / finish_time:.0f}W Avg)")
+    if "transition_table" in sim_solver_params:
+        table = sim_solver_params["transition_table"]
+        print(f"Transition table:\t{table.max_error:.3f}m/s max. error ({table.rms_error:.3f}m/s RMS)")
+    forced_segments = sim.get_forced_segments()
+    if len(forced_segments) > 0:
+        print(f"Forced power:\t\t{len(forced_segments)} segments "
+              f"(+{sum(forced_P * sim.ts[t] for t, forced_P in forced_segments) / 1000:.1f}kJ)")
 
     print("\nPacing Plan:")
     for t in range(len(ds)):
+        forced = f" [+{sim.forced_Ps[t]:.0f}W forced]" if sim.forced_Ps[t] > 0 else ""
         print(f"{sim.ts[t]:.1f}s ({sim.ds[t]:.0f}m) at {sim.Ps[t]:.0f}W ({sim.delta_hs[t] / sim.ds[t] * 100:.1f}%, "
-              f"{sim.vs[t] * 3.6:.1f}km/h)")
+              f"{sim.vs[t] * 3.6:.1f}km/h){forced}")
+
+    if args.save_plan is not None:
+        numpy.savetxt(args.save_plan, sim.Ps, fmt="%.1f")
 
     sim.plot(show_speed=True, show_power=True, show_elevation=True, show_average_power=True,
              title=f"Optimal pacing for {args.course}")
@@ -0,0 +1,258 @@
+import argparse
+import copy
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import multiprocessing.shared_memory
+import sys
+
+import numpy
+
+from lib import CoursePreparation, Simulation, ParamReader, TransitionTable
+
+# Fields of the params file that can be swept, the wind fields are stored as "wind": {"direction", "speed"}
+SWEEP_FIELDS = ["CdA", "Crr", "m", "wind_direction", "wind_speed", "temperature", "pressure"]
+
+# Number of rows that are collected before they are written to a parquet file
+PARQUET_BATCH_SIZE = 4096
+
+# State of the worker processes
+_worker_shared_memories = None
+_worker_sim = None
+_worker_config = None
+
+
+def parse_grid(values: list):
+    # Every value is either a number or start:stop:num for num evenly spaced values
+    grid = []
+    for value in values:
+        if ":" in value:
+            start, stop, num = value.split(":")
+            grid += numpy.linspace(float(start), float(stop), int(num)).tolist()
+        else:
+            grid.append(float(value))
+    return grid
+
+
+def get_root(base_root: dict, values: dict):
+    root = copy.deepcopy(base_root)
+    for field, value in values.items():
+        if field.startswith("wind_"):
+            root.setdefault("wind", {"direction": 0, "speed": 0})[field[len("wind_"):]] = value
+        else:
+            root[field] = value
+    return root
+
+
+def share(array: numpy.ndarray):
+    # Copies the array to a new block of shared memory, which needs to be closed and unlinked by the caller
+    shared_memory = multiprocessing.shared_memory.SharedMemory(create=True, size=array.nbytes)
+    numpy.ndarray(array.shape, dtype=float, buffer=shared_memory.buf)[:] = array
+    return shared_memory
+
+
+def _init_worker(shared_memory_names, num_segments, config):
+    global _worker_shared_memories, _worker_sim, _worker_config
+    # The course and the transition table are only attached, not copied, the references to the shared memory need to be
+    # kept alive
+    _worker_shared_memories = [multiprocessing.shared_memory.SharedMemory(name=name) for name in shared_memory_names]
+    ds, delta_hs, Psis = numpy.ndarray((3, num_segments), dtype=float, buffer=_worker_shared_memories[0].buf)
+    _worker_sim = Simulation.Simulation(ds, delta_hs, Psis)
+    if config["transition_table"] is not None:
+        table_config = config["transition_table"]
+        values = numpy.ndarray([len(axis) for axis in table_config["axes"]], dtype=float,
+                               buffer=_worker_shared_memories[1].buf)
+        table = TransitionTable.TransitionTable(table_config["params"], table_config["axes"], values,
+                                                max_error=table_config["max_error"],
+                                                rms_error=table_config["rms_error"])
+        config = dict(config, solver_params=dict(config["solver_params"], transition_table=table))
+    _worker_config = config
+
+
+def _evaluate(values: dict):
+    # Evaluates all powers for one combination of the other fields at once
+    params = ParamReader.get_params(get_root(_worker_config["root"], values))
+    powers = numpy.array(_worker_config["powers"])
+    Ps = numpy.repeat(powers[:, None], len(_worker_sim.ds), axis=1)
+
+    _, _, _, total_times, average_powers = _worker_sim.forward_batch(
+        Ps, params, initial_velocity=_worker_config["initial_velocity"], solver=_worker_config["solver"],
+        solver_params=_worker_config["solver_params"])
+
+    return [{**values, "power": power, "total_time": total_time, "average_power": average_power}
+            for power, total_time, average_power in zip(powers, total_times, average_powers)]
+
+
+class CsvWriter:
+    def __init__(self, fname, columns):
+        self.file = open(fname, "w", newline="") if fname is not None else sys.stdout
+        self.writer = csv.DictWriter(self.file, fieldnames=columns)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetWriter:
+    def __init__(self, fname, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Writing parquet files requires pyarrow!")
+            sys.exit(1)
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([(column, pyarrow.float64()) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(fname, self.schema)
+        self.rows = []
+
+    def write(self, rows):
+        self.rows += rows
+        if len(self.rows) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pyarrow.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser("Evaluate the time for a course over a grid of parameters and powers")
+    parser.add_argument("course", type=str, help="The gpx/fit file of the course")
+    parser.add_argument("--params", dest="params", type=str, default="params.json",
+                        help="Params file, used for all fields that are not swept")
+    for field in SWEEP_FIELDS:
+        parser.add_argument(f"--{field}", dest=field, type=str, nargs="+", default=None,
+                            help=f"Values for {field}, either numbers or start:stop:num")
+    parser.add_argument("--power", dest="power", type=str, nargs="+", default=["300"],
+                        help="Constant powers (in Watts), either numbers or start:stop:num")
+    parser.add_argument("--output", dest="output", type=str, default=None,
+                        help="Output file (.csv or .parquet), CSV to stdout if not set")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=None,
+                        help="Number of worker processes, defaults to the number of cores")
+    parser.add_argument("--segment_len", dest="segment_len", type=float, help="Length of a segment over which constant"
+                                                                              "power is assumed", default=100)
+    parser.add_argument("--elevation_smooth_window", dest="elevation_smooth_window", type=float,
+                        help="Size of the window used for elevation smoothing", default=50)
+    parser.add_argument("--elevation_smooth_std_dev", dest="elevation_smooth_std_dev", type=float,
+                        help="Standard deviation of the kernel used for elevation smoothing", default=50)
+    parser.add_argument("--elevation_tolerance", dest="elevation_tolerance", type=float, default=None,
+                        help="Merge segments between changes of the gradient of the elevation profile simplified "
+                             "with this tolerance (in m)")
+    parser.add_argument("--gradient_tolerance", dest="gradient_tolerance", type=float, default=None,
+                        help="Changes of the gradient (in %%) of the simplified profile up to which segments are "
+                             "merged (default: none)")
+    parser.add_argument("--heading_tolerance", dest="heading_tolerance", type=float, default=None,
+                        help="Merge segments as long as the heading changes at most this much (in degrees)")
+    parser.add_argument("--max_segment_len", dest="max_segment_len", type=float, default=None,
+                        help="Maximum length (in m) of merged segments")
+    parser.add_argument("--initial_velocity", dest="init_vel", type=float,
+                        help="Initial velocity (in km/h), needs to be positive", default=30)
+    parser.add_argument("--solver", dest="solver", type=str,
+                        help="Solver to use for dynamics ODE", default="DISTANCE_EULER")
+    parser.add_argument("--distance_euler_step_size", dest="distance_euler_step_size", type=float,
+                        help="Step size for the DISTANCE_EULER solver", default=1)
+    parser.add_argument("--time_euler_step_size", dest="time_euler_step_size", type=float,
+                        help="Step size for the TIME_EULER solver", default=0.1)
+    parser.add_argument("--min_time_euler_step_size", dest="min_time_euler_step_size", type=float,
+                        help="Step size for the TIME_EULER solver at which to stop solving", default=0.01)
+    parser.add_argument("--rk_tolerance", dest="rk_tolerance", type=float,
+                        help="Tolerance for the velocity (in m/s) of every step of the DISTANCE_RK45 solver",
+                        default=0.001)
+    parser.add_argument("--no_cache", dest="use_cache", action="store_false",
+                        help="Do not read or write the preprocessed course from/to the cache")
+    parser.add_argument("--cache_dir", dest="cache_dir", type=str, help="Directory of the course cache", default=None)
+    args = parser.parse_args()
+
+    root = json.load(open(args.params, "r"))
+    if not args.course.endswith(CoursePreparation.SUPPORTED_FORMATS):
+        print("Unknown file format!")
+        sys.exit(1)
+    ds, delta_hs, Psis = CoursePreparation.prepare_course(args.course, segment_len=args.segment_len,
+                                                          elevation_smooth_window=args.elevation_smooth_window,
+                                                          elevation_smooth_std_dev=args.elevation_smooth_std_dev,
+                                                          elevation_tolerance=args.elevation_tolerance,
+                                                          gradient_tolerance=args.gradient_tolerance / 100
+                                                          if args.gradient_tolerance is not None else None,
+                                                          heading_tolerance=math.radians(args.heading_tolerance)
+                                                          if args.heading_tolerance is not None else None,
+                                                          max_segment_len=args.max_segment_len,
+                                                          use_cache=args.use_cache, cache_dir=args.cache_dir)
+
+    swept_fields = [field for field in SWEEP_FIELDS if getattr(args, field) is not None]
+    grids = [parse_grid(getattr(args, field)) for field in swept_fields]
+    combinations = [dict(zip(swept_fields, values)) for values in itertools.product(*grids)]
+
+    solver = Simulation.Solver[args.solver.upper()]
+    solver_params = {"distance_euler_step_size": args.distance_euler_step_size,
+                     "time_euler_step_size": args.time_euler_step_size,
+                     "min_time_euler_step_size": args.min_time_euler_step_size,
+                     "rk_tolerance": args.rk_tolerance}
+    table = None
+    if solver == Simulation.Solver.TRANSITION_TABLE:
+        # Building a table takes far longer than simulating all powers of a combination, thus a single table is built
+        # (before the workers are started) and only if all combinations share it (only the wind is swept)
+        table_params = [ParamReader.get_params(get_root(root, values)) for values in combinations]
+        if len({tuple(float(params[field]) for field in TransitionTable.PARAM_FIELDS) for params in table_params}) > 1:
+            print("The TRANSITION_TABLE solver requires the same CdA, Crr, m, temperature and pressure for all "
+                  "combinations, using DISTANCE_RK45 instead", file=sys.stderr)
+            solver = Simulation.Solver.DISTANCE_RK45
+            solver_params["rk_tolerance"] = TransitionTable.INTEGRATOR_TOLERANCE
+        else:
+            table = TransitionTable.get_transition_table(table_params[0], ds, use_cache=args.use_cache,
+                                                         cache_dir=args.cache_dir)
+            print(f"Transition table:\t{table.max_error:.3f}m/s max. error ({table.rms_error:.3f}m/s RMS)",
+                  file=sys.stderr)
+
+    config = {
+        "root": root,
+        "powers": parse_grid(args.power),
+        "initial_velocity": args.init_vel / 3.6,
+        "solver": solver,
+        "solver_params": solver_params,
+        "transition_table": None
+    }
+
+    columns = swept_fields + ["power", "total_time", "average_power"]
+    if args.output is not None and args.output.endswith(".parquet"):
+        writer = ParquetWriter(args.output, columns)
+    else:
+        writer = CsvWriter(args.output, columns)
+
+    # The course (and the transition table) is placed in shared memory once instead of being sent to every worker, the
+    # workers do not use the cache for the table (its entry might be evicted while the sweep runs)
+    shared_memories = []
+    try:
+        shared_memories.append(share(numpy.array([ds, delta_hs, Psis], dtype=float)))
+        if table is not None:
+            shared_memories.append(share(table.values))
+            config["transition_table"] = {"params": table.params, "axes": [axis.tolist() for axis in table.axes],
+                                          "max_error": table.max_error, "rms_error": table.rms_error}
+        with multiprocessing.Pool(args.jobs, initializer=_init_worker,
+                                  initargs=([shared_memory.name for shared_memory in shared_memories], len(ds),
+                                            config)) as pool:
+            for i, rows in enumerate(pool.imap_unordered(_evaluate, combinations)):
+                writer.write(rows)
+                print(f"\r{i + 1}/{len(combinations)}", end="", file=sys.stderr)
+        print(file=sys.stderr)
+    finally:
+        writer.close()
+        for shared_memory in shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
+
+
+if __name__ == "__main__":
+    main()
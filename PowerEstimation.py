@@ -1,48 +1,151 @@
 import argparse
+import csv
 import datetime
+import multiprocessing
 import sys
 
-from lib import GpxReader, Simulation, ParamReader, FitReader
+import numpy
+
+from lib import CoursePreparation, Simulation, ParamReader
+
+MIN_POWER = 0
+MAX_POWER = 2000
+
+# State of the worker processes in batch mode
+_worker_args = None
+_worker_params = None
+_worker_courses = dict()
+
+
+def parse_time(time: str):
+    # Accepts [[HH:]MM:]SS
+    seconds = 0
+    for part in time.split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def estimate_power(sim: Simulation.Simulation, params: dict, total_time: float, resolution: float):
+    # Finds the constant power for which the simulated time equals total_time using Newton's method with the derivative
+    # of the total time with respect to the power, safeguarded by bisection. Returns the power and the number of
+    # forward passes.
+    lower_bound = MIN_POWER
+    upper_bound = MAX_POWER
+    power = (upper_bound + lower_bound) / 2
+    forward_passes = 0
+
+    while True:
+        sim.forward([power] * len(sim.ds), params, compute_sensitivities=True)
+        forward_passes += 1
+
+        error = sim.get_total_time() - total_time
+        if error > 0:
+            lower_bound = power
+        else:
+            upper_bound = power
+
+        # Derivative of the total time (sum of d_t / v_t) with respect to all powers
+        dcost_dvs = Simulation.Simulation.get_time_jacobian(numpy.array(sim.vs), numpy.append(sim.ds, 0))
+        derivative = sum(sim.backward(dcost_dvs))
+
+        if upper_bound - lower_bound <= resolution:
+            break
+
+        if derivative < 0:
+            new_power = power - error / derivative
+            # Step at least by the resolution, close to the root this shrinks the bracket to the resolution
+            if abs(new_power - power) < resolution:
+                new_power = power + resolution if error > 0 else power - resolution
+        else:
+            new_power = (upper_bound + lower_bound) / 2
+
+        if not lower_bound < new_power < upper_bound:
+            new_power = (upper_bound + lower_bound) / 2
+
+        power = new_power
+
+    return power, forward_passes
+
+
+def _init_worker(args):
+    global _worker_args, _worker_params
+    _worker_args = args
+    _worker_params = ParamReader.read_params(args.params)
+
+
+def _estimate_row(row):
+    course, time = row
+    if course not in _worker_courses:
+        ds, delta_hs, Psis = CoursePreparation.prepare_course(course, use_cache=_worker_args.use_cache,
+                                                              cache_dir=_worker_args.cache_dir)
+        _worker_courses[course] = Simulation.Simulation(ds, delta_hs, Psis)
+
+    sim = _worker_courses[course]
+    power, forward_passes = estimate_power(sim, _worker_params, parse_time(time), _worker_args.resolution)
+    return course, time, power, sim.get_total_time(), forward_passes
+
+
+def run_batch(args):
+    # Every row of the csv (with the columns course and time) is estimated, the rows are sorted by course so that
+    # every worker can reuse the parsed course for consecutive rows
+    with open(args.batch, newline="") as f:
+        rows = [(row["course"], row["time"]) for row in csv.DictReader(f)]
+
+    for course in set(course for course, _ in rows):
+        if not course.endswith(CoursePreparation.SUPPORTED_FORMATS):
+            print(f"Unknown file format: {course}!")
+            sys.exit(1)
+        # Fills the cache once, the workers only need to load the prepared course
+        CoursePreparation.prepare_course(course, use_cache=args.use_cache, cache_dir=args.cache_dir)
+
+    rows = sorted(rows, key=lambda row: row[0])
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["course", "time", "power", "simulated_time", "forward_passes"])
+    with multiprocessing.Pool(args.jobs, initializer=_init_worker, initargs=(args,)) as pool:
+        for course, time, power, simulated_time, forward_passes in pool.imap(_estimate_row, rows, chunksize=4):
+            writer.writerow([course, time, f"{power:.3f}", f"{simulated_time:.3f}", forward_passes])
 
 
 def main():
     parser = argparse.ArgumentParser("Estimate the time required for a course for a fixed power")
-    parser.add_argument("course", metavar="F", type=str,
+    parser.add_argument("course", metavar="F", type=str, nargs="?",
                         help="The gpx/fit file of the course")
     parser.add_argument("--params", dest="params", type=str, help="Params file", default="params.json")
     parser.add_argument("--resolution", dest="resolution", type=float, help="Required resolution for the power",
                         default=0.001)
-    parser.add_argument("--time", dest="time", type=str, help="Time for the segment")
+    parser.add_argument("--time", dest="time", type=str, help="Time for the segment ([[HH:]MM:]SS)")
+    parser.add_argument("--batch", dest="batch", type=str, default=None,
+                        help="CSV file with the columns course and time, the estimates are written to stdout as CSV")
+    parser.add_argument("--jobs", dest="jobs", type=int, default=None,
+                        help="Number of worker processes in batch mode, defaults to the number of cores")
+    parser.add_argument("--no_cache", dest="use_cache", action="store_false",
+                        help="Do not read or write the parsed course from/to the cache")
+    parser.add_argument("--cache_dir", dest="cache_dir", type=str, help="Directory of the course cache", default=None)
     args = parser.parse_args()
 
+    if args.batch is not None:
+        run_batch(args)
+        return
+
+    if args.course is None or args.time is None:
+        parser.error("the course and --time are required unless --batch is given")
+
     params = ParamReader.read_params(args.params)
-    if args.course.endswith(".gpx"):
-        ds, delta_hs, Psis = GpxReader.read_gpx(args.course)
-    elif args.course.endswith(".fit"):
-        ds, delta_hs, Psis, _, _ = FitReader.read_fit(args.course)
-    else:
+    if not args.course.endswith(CoursePreparation.SUPPORTED_FORMATS):
         print("Unknown file format!")
         sys.exit(1)
+    ds, delta_hs, Psis = CoursePreparation.prepare_course(args.course, use_cache=args.use_cache,
+                                                          cache_dir=args.cache_dir)
 
     sim = Simulation.Simulation(ds, delta_hs, Psis)
 
-    lower_bound = 0
-    upper_bound = 2000
+    real_total_time = parse_time(args.time)
 
-    real_total_time = (datetime.datetime.strptime(args.time, "%M:%S") - datetime.datetime(1900, 1, 1)).total_seconds()
-
-    while abs(upper_bound - lower_bound) > args.resolution:
-        mid = (upper_bound + lower_bound) / 2
-
-        sim.forward([mid] * len(ds), params)
-
-        if sim.get_total_time() > real_total_time:
-            lower_bound = mid
-        else:
-            upper_bound = mid
+    power, forward_passes = estimate_power(sim, params, real_total_time, args.resolution)
 
     print(
-        f"\nSimulated Total time:\t{datetime.timedelta(seconds=sim.get_total_time())}\n"
+        f"\nPower:\t\t\t\t\t{power:.1f}W ({forward_passes} simulations)\n"
+        f"Simulated Total time:\t{datetime.timedelta(seconds=sim.get_total_time())}\n"
         f"Real Total time:\t\t{datetime.timedelta(seconds=real_total_time)}\n"
         f"Total distance:\t\t\t{sim.get_total_distance() / 1000:.3f}km\n"
         f"Avg. Speed:\t\t\t\t{sim.get_average_speed() * 3.6:.1f}km/h\n"
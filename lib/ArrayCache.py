@@ -0,0 +1,78 @@
+import hashlib
+import os
+
+import numpy
+
+
+def get_file_hash(path, chunk_size=2 ** 20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def save(path, arrays):
+    # Stores arrays of the same length as rows of a single .npy file, the file is replaced atomically so that
+    # concurrent readers never see a partially written file
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        numpy.save(f, numpy.array(arrays, dtype=float))
+    os.replace(tmp_path, path)
+
+
+def load(path):
+    # Memory maps a file written by save, returns the rows
+    return tuple(numpy.load(path, mmap_mode="r"))
+
+
+# Default size limit of a cache directory, the least recently used entries are removed above this size
+DEFAULT_MAX_SIZE = 2 ** 30
+
+
+def get_default_cache_dir():
+    return os.environ.get("BIKE_SIMULATION_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "bike_simulation"))
+
+
+def get_key(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def lookup(cache_dir, key):
+    # Returns the (memory mapped) arrays stored for key or None, a hit marks the entry as recently used
+    path = os.path.join(cache_dir, f"{key}.npy")
+    try:
+        os.utime(path)
+        return load(path)
+    except (OSError, ValueError):
+        return None
+
+
+def store(cache_dir, key, arrays, max_size=DEFAULT_MAX_SIZE):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        save(os.path.join(cache_dir, f"{key}.npy"), arrays)
+        evict(cache_dir, max_size)
+    except OSError:
+        # Not being able to write the cache (e.g. read only directory) is not an error
+        pass
+
+
+def evict(cache_dir, max_size=DEFAULT_MAX_SIZE):
+    # Removes the least recently used entries until the directory is at most max_size bytes
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and entry.name.endswith(".npy"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_size -= size
@@ -0,0 +1,50 @@
+from . import ArrayCache, ElevationSmoothing, FitReader, GpxReader, RouteNormalization
+
+SUPPORTED_FORMATS = (".gpx", ".fit")
+
+
+def read_course(path, use_cache=True):
+    if path.endswith(".gpx"):
+        return GpxReader.read_gpx(path)
+    elif path.endswith(".fit"):
+        ds, delta_hs, Psis, _, _ = FitReader.read_fit(path, use_cache=use_cache)
+        return ds, delta_hs, Psis
+    else:
+        raise ValueError("Unknown file format!")
+
+
+def prepare_course(path, segment_len=None, elevation_smooth_window=None, elevation_smooth_std_dev=None,
+                   circular_mean_heading=False, elevation_tolerance=None, gradient_tolerance=None,
+                   heading_tolerance=None, max_segment_len=None, use_cache=True, cache_dir=None,
+                   max_cache_size=ArrayCache.DEFAULT_MAX_SIZE):
+    # Reads the course and optionally normalizes it to segments of segment_len, smooths the elevation and merges
+    # segments (see RouteNormalization.simplify, if any of the tolerances is set). The result is cached (keyed by the
+    # content of the file and all arguments) so that repeated runs skip all preprocessing.
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = ArrayCache.get_default_cache_dir()
+        key = ArrayCache.get_key("course", ArrayCache.get_file_hash(path), segment_len, elevation_smooth_window,
+                                 elevation_smooth_std_dev, circular_mean_heading, elevation_tolerance,
+                                 gradient_tolerance, heading_tolerance, max_segment_len)
+        cached = ArrayCache.lookup(cache_dir, key)
+        if cached is not None:
+            return cached
+
+    ds, delta_hs, Psis = read_course(path, use_cache=use_cache)
+    if segment_len is not None:
+        ds, delta_hs, Psis = RouteNormalization.normalize(ds, delta_hs, Psis, segment_len=segment_len,
+                                                          circular_mean_heading=circular_mean_heading)
+    if elevation_smooth_window is not None:
+        ds, delta_hs, Psis = ElevationSmoothing.smooth_truncated_gaussian(ds, delta_hs, Psis,
+                                                                          width=elevation_smooth_window,
+                                                                          sigma=elevation_smooth_std_dev)
+    if elevation_tolerance is not None or heading_tolerance is not None or max_segment_len is not None:
+        ds, delta_hs, Psis = RouteNormalization.simplify(ds, delta_hs, Psis, elevation_tolerance=elevation_tolerance,
+                                                         gradient_tolerance=gradient_tolerance,
+                                                         heading_tolerance=heading_tolerance,
+                                                         max_segment_len=max_segment_len)
+
+    if use_cache:
+        ArrayCache.store(cache_dir, key, [ds, delta_hs, Psis], max_size=max_cache_size)
+
+    return ds, delta_hs, Psis
@@ -0,0 +1,114 @@
+import json
+
+import numpy
+
+# Tuning constant of the huber weights, relative to the (robust) standard deviation of the residuals
+HUBER_THRESHOLD = 1.345
+
+# Scales the median absolute deviation to the standard deviation of a normal distribution
+MAD_TO_STD_DEV = 1.4826
+
+
+def get_regression_data(ds, delta_hs, Psis, Ps, ts, params: dict, min_power=50):
+    # For every sample the power of the rider minus the power for climbing and accelerating remains for drag and
+    # rolling resistance:
+    #   P - m g delta_h / t - m v dv/dt = CdA * 1/2 rho v_air^3 + Crr * m g v
+    # Returns the regressors (one row per sample, columns for CdA and Crr) and the remaining power
+    ds = numpy.asarray(ds, dtype=float)
+    delta_hs = numpy.asarray(delta_hs, dtype=float)
+    Psis = numpy.asarray(Psis, dtype=float)
+    Ps = numpy.asarray(Ps, dtype=float)
+    ts = numpy.asarray(ts, dtype=float)
+
+    valid = (ds > 0) & (ts > 0)
+    ds, delta_hs, Psis, Ps, ts = ds[valid], delta_hs[valid], Psis[valid], Ps[valid], ts[valid]
+    if len(ds) < 2:
+        return numpy.empty((0, 2)), numpy.empty(0)
+
+    vs = ds / ts
+    dv_dts = numpy.gradient(vs, numpy.cumsum(ts))
+    v_airs = vs - numpy.cos(params["omega"] - Psis) * params["v_w"]
+
+    m = params["m"]
+    g = params["g"]
+    X = numpy.column_stack([0.5 * params["rho"] * v_airs ** 3, m * g * vs])
+    y = Ps - m * g * delta_hs / ts - m * vs * dv_dts
+
+    powered = (Ps > min_power) & numpy.isfinite(y)
+    return X[powered], y[powered]
+
+
+def get_huber_weights(residuals: numpy.ndarray):
+    scale = MAD_TO_STD_DEV * numpy.median(numpy.abs(residuals - numpy.median(residuals)))
+    threshold = HUBER_THRESHOLD * max(scale, 1e-9)
+    return numpy.minimum(1, threshold / numpy.maximum(numpy.abs(residuals), 1e-12))
+
+
+class SufficientStatistics:
+    # Sums of the normal equations of the least squares problem, the statistics of multiple activities are combined by
+    # adding them. The files that are included are tracked by their hash, so that a file is only added once.
+    def __init__(self):
+        self.xtx = numpy.zeros((2, 2))
+        self.xty = numpy.zeros(2)
+        self.yty = 0.0
+        self.n = 0
+        self.files = dict()
+
+    def add(self, X: numpy.ndarray, y: numpy.ndarray, weights=None):
+        if weights is None:
+            weights = numpy.ones(len(y))
+        self.xtx += X.T @ (weights[:, None] * X)
+        self.xty += X.T @ (weights * y)
+        self.yty += float(weights @ (y * y))
+        self.n += len(y)
+
+    def merge(self, other):
+        self.xtx += other.xtx
+        self.xty += other.xty
+        self.yty += other.yty
+        self.n += other.n
+        self.files.update(other.files)
+
+    def solve(self):
+        # Returns the estimate (CdA, Crr) and its covariance
+        if self.n <= 2:
+            raise ValueError("Not enough samples for the least squares fit")
+        estimate = numpy.linalg.solve(self.xtx, self.xty)
+        residual_sum_of_squares = self.yty - 2 * estimate @ self.xty + estimate @ self.xtx @ estimate
+        variance = max(residual_sum_of_squares, 0) / (self.n - 2)
+        return estimate, variance * numpy.linalg.inv(self.xtx)
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            json.dump({"xtx": self.xtx.tolist(), "xty": self.xty.tolist(), "yty": self.yty, "n": self.n,
+                       "files": self.files}, f, indent=4)
+
+    @staticmethod
+    def load(fname):
+        with open(fname, "r") as f:
+            root = json.load(f)
+        statistics = SufficientStatistics()
+        statistics.xtx = numpy.array(root["xtx"], dtype=float)
+        statistics.xty = numpy.array(root["xty"], dtype=float)
+        statistics.yty = root["yty"]
+        statistics.n = root["n"]
+        statistics.files = root["files"]
+        return statistics
+
+
+def get_statistics(X: numpy.ndarray, y: numpy.ndarray, robust=False, iterations=10):
+    # Statistics of a single activity, with robust set the samples are re-weighted with huber weights of the residuals
+    # (iteratively reweighted least squares), only the data of this activity is required for this
+    statistics = SufficientStatistics()
+    statistics.add(X, y)
+    if robust and len(y) > 2:
+        for _ in range(iterations):
+            try:
+                estimate, _ = statistics.solve()
+            except numpy.linalg.LinAlgError:
+                break
+            weights = get_huber_weights(y - X @ estimate)
+            statistics = SufficientStatistics()
+            statistics.add(X, y, weights)
+    return statistics
+
@@ -1,5 +1,13 @@
 import math
 
+import numpy
+
+# Number of window entries that are evaluated at once in the general (non uniform) case
+_CHUNK_SIZE = 2 ** 20
+
+# Kernel size above which the convolution is done using the FFT
+_FFT_KERNEL_SIZE = 128
+
 
 def gaussian_pdf(x, mu, sigma):
     return 1 / (math.sqrt(2 * math.pi) * sigma) * math.exp(-.5 * ((x - mu) / sigma) ** 2)
@@ -9,53 +17,64 @@ def gaussian_cdf(x, mu, sigma):
     return .5 * (1 + math.erf((x - mu) / (sigma * math.sqrt(2))))
 
 
-def smooth_truncated_gaussian(ds: list, delta_hs: list, Psis: list, sigma, width):
-    def truncated_gaussian_weight(x, a, b):
-        mu = 0
-        normalization = gaussian_cdf(mu + b, mu, sigma) - gaussian_cdf(mu - a, mu, sigma)
-        return gaussian_pdf(x, mu, sigma) / normalization
+def _convolve(values: numpy.ndarray, kernel: numpy.ndarray):
+    # Same as numpy.convolve(values, kernel, "same") for kernels of odd size
+    if len(kernel) < _FFT_KERNEL_SIZE:
+        return numpy.convolve(values, kernel, "same")
 
-    new_delta_hs = []
+    size = len(values) + len(kernel) - 1
+    result = numpy.fft.irfft(numpy.fft.rfft(values, size) * numpy.fft.rfft(kernel, size), size)
+    offset = (len(kernel) - 1) // 2
+    return result[offset:offset + len(values)]
 
+
+def smooth_truncated_gaussian(ds, delta_hs, Psis, sigma, width):
+    # For every segment the window extends to both sides until at least width / 2 is covered (but at least one
+    # neighbour), the weights are given by a gaussian over the distance between the segment centres, truncated to the
+    # window. The normalization of the truncated gaussian is the same for all weights of a window and thus cancels.
     assert len(ds) == len(delta_hs)
-    for i in range(len(ds)):
-        # Get actual width and distances from centre to centre
-        left_index = right_index = i
-        left_dist = right_dist = 0
-        distances = dict()
-        distances[i] = 0
-        while True:
-            if left_index - 1 < 0:
-                break
-            else:
-                left_index -= 1
-                distances[left_index] = left_dist + ds[left_index] / 2 + ds[i] / 2
-                left_dist += ds[left_index]
-                if left_dist >= width / 2:
-                    break
-
-        while True:
-            if right_index + 1 > len(ds) - 1:
-                break
-            else:
-                right_index += 1
-                distances[right_index] = right_dist + ds[right_index] / 2 + ds[i] / 2
-                right_dist += ds[right_index]
-                if right_dist >= width / 2:
-                    break
-
-        # Calculate weights for segments:
-        weights = dict()
-        weight_sum = 0
-        for index, dist in distances.items():
-            weight = truncated_gaussian_weight(dist, left_dist, right_dist)
-            weights[index] = weight
-            weight_sum += weight
-
-        # Update delta_h
-        new_delta_h = 0
-        for index, weight in weights.items():
-            new_delta_h += delta_hs[index] * weight / weight_sum
-        new_delta_hs.append(new_delta_h)
+    ds = numpy.asarray(ds, dtype=float)
+    delta_hs = numpy.asarray(delta_hs, dtype=float)
+    num_segments = len(ds)
+
+    xs = numpy.concatenate(([0], numpy.cumsum(ds)))
+    centres = xs[:-1] + ds / 2
+    indices = numpy.arange(num_segments)
+
+    lower = numpy.searchsorted(xs, xs[:-1] - width / 2, side="right") - 1
+    lower = numpy.maximum(numpy.minimum(lower, indices - 1), 0)
+    upper = numpy.searchsorted(xs, xs[1:] + width / 2, side="left") - 1
+    upper = numpy.minimum(numpy.maximum(upper, indices + 1), num_segments - 1)
+
+    new_delta_hs = numpy.empty(num_segments)
+    remaining = numpy.ones(num_segments, dtype=bool)
+
+    # Fast path: windows which only contain segments of the same length share a kernel
+    segment_len = ds[0]
+    non_uniform = numpy.concatenate(([0], numpy.cumsum(~numpy.isclose(ds, segment_len))))
+    half_width = int(max((indices - lower).max(), (upper - indices).max()))
+    uniform = (non_uniform[upper + 1] == non_uniform[lower]) \
+              & (lower == numpy.maximum(indices - half_width, 0)) \
+              & (upper == numpy.minimum(indices + half_width, num_segments - 1))
+    if uniform.any():
+        offsets = numpy.arange(-half_width, half_width + 1) * segment_len
+        kernel = numpy.exp(-.5 * (offsets / sigma) ** 2)
+        new_delta_hs[uniform] = _convolve(delta_hs, kernel)[uniform] / _convolve(numpy.ones(num_segments),
+                                                                                 kernel)[uniform]
+        remaining = ~uniform
+
+    # General case: evaluate the windows of the remaining segments in chunks
+    rows = indices[remaining]
+    if len(rows) > 0:
+        window_size = int((upper[rows] - lower[rows]).max()) + 1
+        chunk = max(_CHUNK_SIZE // window_size, 1)
+        for start in range(0, len(rows), chunk):
+            chunk_rows = rows[start:start + chunk]
+            window = lower[chunk_rows, None] + numpy.arange(window_size)
+            valid = window <= upper[chunk_rows, None]
+            window = numpy.minimum(window, num_segments - 1)
+
+            weights = numpy.exp(-.5 * ((centres[window] - centres[chunk_rows, None]) / sigma) ** 2) * valid
+            new_delta_hs[chunk_rows] = (weights * delta_hs[window]).sum(axis=1) / weights.sum(axis=1)
 
     return ds, new_delta_hs, Psis
@@ -1,45 +1,78 @@
+import glob
+import math
+import os
+
 import fitparse
-from .HeadingFromPoints import get_heading
-
-
-def read_fit(fname):
-    fitfile = fitparse.FitFile(fname)
-
-    ds = []
-    delta_hs = []
-    Psis = []
-    ps = []
-    ts = []
-
-    records = fitfile.get_messages("record")
-
-    last_alt = None
-    last_timestamp = None
-    total_distance = None
-    last_pt = None
-
-    for record in records:
-        alt = record.get_value("altitude")
-        dist = record.get_value("distance")
-        power = record.get_value("power")
-        stamp = record.get_value("timestamp")
-        # https://gis.stackexchange.com/a/384263
-        lat = record.get_value("position_lat") * 180 / 2 ** 31
-        lon = record.get_value("position_long") * 180 / 2 ** 31
-        pt = (lat, lon)
-
-        if alt is not None and dist is not None and power is not None and stamp is not None and pt is not None:
-            if last_alt is not None and last_pt is not None:
-                ds.append(dist - total_distance)
-                delta_hs.append(alt - last_alt)
-                Psis.append(get_heading(*last_pt, *pt))
-                ps.append(power)
-                ts.append((stamp - last_timestamp).total_seconds())
-
-            total_distance = dist
-
-            last_alt = alt
-            last_timestamp = stamp
-            last_pt = pt
+import fitparse.processors
+import numpy
+
+from . import ArrayCache, Geodesy
+
+# https://gis.stackexchange.com/a/384263
+SEMICIRCLES_TO_RADIANS = math.pi / 2 ** 31
+
+FIELDS = ["timestamp", "distance", "altitude", "power", "position_lat", "position_long"]
+
+
+class _RawDataProcessor(fitparse.processors.FitFileDataProcessor):
+    # Skips all conversions (e.g. timestamps to datetime), timestamps stay in seconds
+    def run_type_processor(self, field_data):
+        pass
+
+    def run_field_processor(self, field_data):
+        pass
+
+    def run_unit_processor(self, field_data):
+        pass
+
+    def run_message_processor(self, data_message):
+        pass
+
+
+def get_cache_path(fname):
+    # The parsed activity is stored next to the file, keyed by the hash and modification time of the file
+    stat = os.stat(fname)
+    directory, name = os.path.split(os.path.abspath(fname))
+    return os.path.join(directory, f".{name}.{ArrayCache.get_file_hash(fname)[:16]}-{stat.st_mtime_ns}.npy")
+
+
+def decode_records(fname):
+    # Reads all records with all fields present into one numpy column per field
+    fitfile = fitparse.FitFile(fname, data_processor=_RawDataProcessor())
+    columns = {field: [] for field in FIELDS}
+
+    for record in fitfile.get_messages("record"):
+        values = record.get_values()
+        if all(values.get(field) is not None for field in FIELDS):
+            for field in FIELDS:
+                columns[field].append(values[field])
+
+    return {field: numpy.array(column, dtype=float) for field, column in columns.items()}
+
+
+def read_fit(fname, use_cache=True):
+    if use_cache:
+        cache_path = get_cache_path(fname)
+        if os.path.exists(cache_path):
+            return ArrayCache.load(cache_path)
+
+    columns = decode_records(fname)
+
+    ds = numpy.diff(columns["distance"])
+    delta_hs = numpy.diff(columns["altitude"])
+    Psis = Geodesy.get_headings(columns["position_lat"] * SEMICIRCLES_TO_RADIANS,
+                                columns["position_long"] * SEMICIRCLES_TO_RADIANS)
+    ps = columns["power"][1:]
+    ts = numpy.diff(columns["timestamp"])
+
+    if use_cache:
+        try:
+            directory, name = os.path.split(os.path.abspath(fname))
+            for stale_path in glob.glob(os.path.join(glob.escape(directory), glob.escape(f".{name}.") + "*.npy")):
+                os.remove(stale_path)
+            ArrayCache.save(cache_path, [ds, delta_hs, Psis, ps, ts])
+        except OSError:
+            # Not being able to write the cache (e.g. read only directory) is not an error
+            pass
 
     return ds, delta_hs, Psis, ps, ts
@@ -0,0 +1,83 @@
+import numpy
+
+# WGS-84 ellipsoid
+EQUATORIAL_RADIUS = 6378137.0
+FLATTENING = 1 / 298.257223563
+POLAR_RADIUS = EQUATORIAL_RADIUS * (1 - FLATTENING)
+
+# Mean earth radius, used for the haversine distance
+MEAN_RADIUS = 6371008.8
+
+
+# All functions take the latitudes and longitudes of a track (in radians) and return the value between all consecutive
+# points, i.e. one element less than the number of points.
+
+def get_headings(lats, lons):
+    # Vectorized version of HeadingFromPoints.get_heading
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    last_lats = lats[:-1]
+    lats = lats[1:]
+    d_lons = numpy.diff(lons)
+
+    y = numpy.sin(d_lons) * numpy.cos(lats)
+    x = numpy.cos(last_lats) * numpy.sin(lats) - numpy.sin(last_lats) * numpy.cos(lats) * numpy.cos(d_lons)
+    return numpy.arctan2(y, x) + numpy.pi
+
+
+def get_haversine_distances(lats, lons):
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    d_lats = numpy.diff(lats)
+    d_lons = numpy.diff(lons)
+
+    a = numpy.sin(d_lats / 2) ** 2 + numpy.cos(lats[:-1]) * numpy.cos(lats[1:]) * numpy.sin(d_lons / 2) ** 2
+    return 2 * MEAN_RADIUS * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1)))
+
+
+# https://en.wikipedia.org/wiki/Vincenty%27s_formulae#Inverse_problem
+def get_ellipsoidal_distances(lats, lons, tolerance=1e-12, max_iterations=200):
+    lats = numpy.asarray(lats, dtype=float)
+    lons = numpy.asarray(lons, dtype=float)
+    u_1 = numpy.arctan((1 - FLATTENING) * numpy.tan(lats[:-1]))
+    u_2 = numpy.arctan((1 - FLATTENING) * numpy.tan(lats[1:]))
+    big_l = numpy.diff(lons)
+    sin_u_1, cos_u_1 = numpy.sin(u_1), numpy.cos(u_1)
+    sin_u_2, cos_u_2 = numpy.sin(u_2), numpy.cos(u_2)
+
+    lam = big_l.copy()
+    converged = numpy.zeros(big_l.shape, dtype=bool)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        for _ in range(max_iterations):
+            sin_lam, cos_lam = numpy.sin(lam), numpy.cos(lam)
+            sin_sigma = numpy.sqrt((cos_u_2 * sin_lam) ** 2 + (cos_u_1 * sin_u_2 - sin_u_1 * cos_u_2 * cos_lam) ** 2)
+            cos_sigma = sin_u_1 * sin_u_2 + cos_u_1 * cos_u_2 * cos_lam
+            sigma = numpy.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = numpy.where(sin_sigma > 0, cos_u_1 * cos_u_2 * sin_lam / sin_sigma, 0)
+            cos_sq_alpha = 1 - sin_alpha ** 2
+            # Points on the equator have cos_sq_alpha = 0
+            cos_2_sigma_m = numpy.where(cos_sq_alpha > 0, cos_sigma - 2 * sin_u_1 * sin_u_2 / cos_sq_alpha, 0)
+            c = FLATTENING / 16 * cos_sq_alpha * (4 + FLATTENING * (4 - 3 * cos_sq_alpha))
+            new_lam = big_l + (1 - c) * FLATTENING * sin_alpha * (
+                    sigma + c * sin_sigma * (cos_2_sigma_m + c * cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)))
+
+            converged = numpy.abs(new_lam - lam) <= tolerance
+            lam = new_lam
+            if converged.all():
+                break
+
+    u_sq = cos_sq_alpha * (EQUATORIAL_RADIUS ** 2 - POLAR_RADIUS ** 2) / POLAR_RADIUS ** 2
+    big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+    big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+    delta_sigma = big_b * sin_sigma * (cos_2_sigma_m + big_b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2_sigma_m ** 2)
+            - big_b / 6 * cos_2_sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2_sigma_m ** 2)))
+
+    return POLAR_RADIUS * big_a * (sigma - delta_sigma)
+
+
+def get_distances(lats, lons, ellipsoidal=True):
+    if ellipsoidal:
+        return get_ellipsoidal_distances(lats, lons)
+    else:
+        return get_haversine_distances(lats, lons)
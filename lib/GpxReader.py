@@ -1,33 +1,117 @@
-import math
+import os
+import xml.etree.ElementTree as ElementTree
 
-import gpxpy
-import geopy.distance
-from .HeadingFromPoints import get_heading
+import numpy
 
+from . import Geodesy
 
-def read_gpx(path):
-    gpx_file = open(path, 'r')
-    gpx = gpxpy.parse(gpx_file)
-    assert len(gpx.tracks) == 1
-    assert len(gpx.tracks[0].segments) == 1
-    points = gpx.tracks[0].segments[0].points
+# Number of points that are parsed before they are copied into the output arrays
+CHUNK_SIZE = 4096
 
-    ds = []
-    delta_hs = []
-    Psis = []
+# Rough size of a track point in a gpx file, used to preallocate the output arrays
+BYTES_PER_POINT = 64
 
-    last_pt = points[0]
-    for point in points[1:]:
-        d = geopy.distance.geodesic((last_pt.latitude, last_pt.longitude), (point.latitude, point.longitude)).m
 
-        Psi = get_heading(last_pt.latitude / 180 * math.pi, last_pt.longitude / 180 * math.pi,
-                          point.latitude / 180 * math.pi, point.longitude / 180 * math.pi)
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
 
-        if d > 0:
-            ds.append(d)
-            Psis.append(Psi)
-            delta_hs.append(point.elevation - last_pt.elevation)
 
-        last_pt = point
+def iter_gpx_chunks(path, chunk_size=CHUNK_SIZE):
+    # Parses the file incrementally and yields (track index, segment index, lats, lons, elevations) with at most
+    # chunk_size points each (coordinates in radians, nan for missing elevations). Every element is removed from the
+    # tree as soon as it is parsed, so the memory does not depend on the size of the file.
+    lats = numpy.empty(chunk_size)
+    lons = numpy.empty(chunk_size)
+    elevations = numpy.empty(chunk_size)
+    count = 0
 
-    return ds, delta_hs, Psis
+    track = -1
+    segment = -1
+    parents = []
+
+    for event, element in ElementTree.iterparse(path, events=("start", "end")):
+        name = _local_name(element.tag)
+
+        if event == "start":
+            if name == "trk":
+                track += 1
+                segment = -1
+            elif name == "trkseg":
+                segment += 1
+            parents.append(element)
+            continue
+
+        parents.pop()
+
+        if name == "trkpt":
+            lats[count] = float(element.get("lat"))
+            lons[count] = float(element.get("lon"))
+            elevations[count] = numpy.nan
+            for child in element:
+                if _local_name(child.tag) == "ele" and child.text is not None:
+                    elevations[count] = float(child.text)
+            count += 1
+
+        if (name == "trkpt" and count == chunk_size) or (name == "trkseg" and count > 0):
+            yield track, segment, numpy.radians(lats[:count]), numpy.radians(lons[:count]), elevations[:count].copy()
+            count = 0
+
+        # Only the children of a track point are required after they are parsed
+        if name == "trkpt" or len(parents) <= 3:
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+
+
+def read_gpx(path, tracks=None, segments=None, ellipsoidal=True):
+    # All selected track segments (by default all) are concatenated, tracks and segments are selected by their index
+    # (segments by the index within the track). Points of different segments are never connected.
+    capacity = max(os.path.getsize(path) // BYTES_PER_POINT, CHUNK_SIZE)
+    lats = numpy.empty(capacity)
+    lons = numpy.empty(capacity)
+    elevations = numpy.empty(capacity)
+    segment_starts = []
+    count = 0
+    last_segment = None
+
+    for track, segment, chunk_lats, chunk_lons, chunk_elevations in iter_gpx_chunks(path):
+        if (tracks is not None and track not in tracks) or (segments is not None and segment not in segments):
+            continue
+
+        if (track, segment) != last_segment:
+            segment_starts.append(count)
+            last_segment = (track, segment)
+
+        if count + len(chunk_lats) > capacity:
+            capacity = max(2 * capacity, count + len(chunk_lats))
+            lats = numpy.resize(lats, capacity)
+            lons = numpy.resize(lons, capacity)
+            elevations = numpy.resize(elevations, capacity)
+
+        lats[count:count + len(chunk_lats)] = chunk_lats
+        lons[count:count + len(chunk_lats)] = chunk_lons
+        elevations[count:count + len(chunk_lats)] = chunk_elevations
+        count += len(chunk_lats)
+
+    assert count > 0, "No track points found!"
+    lats = lats[:count]
+    lons = lons[:count]
+    elevations = elevations[:count]
+
+    # Interpolate missing elevations
+    missing = numpy.isnan(elevations)
+    if missing.all():
+        elevations[:] = 0
+    elif missing.any():
+        indices = numpy.arange(count)
+        elevations[missing] = numpy.interp(indices[missing], indices[~missing], elevations[~missing])
+
+    ds = Geodesy.get_distances(lats, lons, ellipsoidal=ellipsoidal)
+    Psis = Geodesy.get_headings(lats, lons)
+    delta_hs = numpy.diff(elevations)
+
+    valid = ds > 0
+    # The step from the last point of a segment to the first point of the next one is not part of the route
+    valid[numpy.array(segment_starts[1:], dtype=int) - 1] = False
+
+    return ds[valid], delta_hs[valid], Psis[valid]
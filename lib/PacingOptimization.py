@@ -0,0 +1,481 @@
+import math
+
+import numpy
+
+from . import RouteNormalization, Simulation
+
+# Step sizes of the line search of the gradient descent, all are evaluated at once
+LINE_SEARCH_ALPHAS = 10.0 ** numpy.arange(-10, 6)
+
+# Maximum ratio of the segment lengths of two consecutive levels of optimize_multigrid
+MULTIGRID_REFINEMENT = 4
+
+# Decades by which optimize_dynamic_programming moves the bracket of the multiplier if the average powers of all plans
+# are on the same side of the target
+DYNAMIC_PROGRAMMING_EXPANSION_DECADES = 1
+
+
+def get_cost_ds(ds, terminal_distance=None):
+    # The cost is the time of every segment and as terminal cost d_{N-1}/v_N, i.e. the time for one more segment at the
+    # final velocity, or terminal_distance/v_N
+    return numpy.append(ds, ds[-1] if terminal_distance is None else terminal_distance)
+
+
+def get_total_cost(sim: Simulation.Simulation, cost_ds: numpy.ndarray):
+    return sim.get_total_time() + cost_ds[-1] / sim.vs[-1]
+
+
+def get_initial_powers(sim: Simulation.Simulation, average_power: float, max_power: float, initial_Ps=None):
+    # Constant power or the given warm start (e.g. the prolonged result of a coarser segmentation)
+    if initial_Ps is None:
+        return numpy.full(len(sim.ds), float(average_power))
+    assert len(initial_Ps) == len(sim.ds)
+    return numpy.clip(numpy.asarray(initial_Ps, dtype=float), 0, max_power)
+
+
+def optimize_line_search(sim: Simulation.Simulation, params: dict, average_power: float, max_power: float,
+                         initial_velocity: float, solver, solver_params: dict, max_iterations=100, power_tolerance=5,
+                         time_tolerance=0.5, initial_Ps=None, terminal_distance=None, callback=None):
+    # Model predictive control based on gradient descent: every iteration takes a step in the direction of the
+    # gradient, the step size is chosen from LINE_SEARCH_ALPHAS after rescaling the powers to the average power. Starts
+    # at initial_Ps or at constant power, sim is left at the optimized powers. Returns the number of iterations and
+    # forward passes.
+    #
+    # System description:
+    #   v_{t+1} = f(v_t, P_t)
+    # State cost = t = d/v_t, Control Cost = 0
+    cost_ds = get_cost_ds(sim.ds, terminal_distance)
+
+    initial_Ps = get_initial_powers(sim, average_power, max_power, initial_Ps)
+    sim.forward(initial_Ps.tolist(), initial_velocity=initial_velocity, params=params, solver=solver,
+                solver_params=solver_params, compute_sensitivities=True)
+    forward_passes = 1
+    last_time = sim.get_total_time()
+    if callback is not None:
+        callback(0, last_time)
+
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        # Back pass, uses the sensitivities of the selected solver
+        dcost_dvs = Simulation.Simulation.get_time_jacobian(numpy.array(sim.vs), cost_ds)
+        steps = [-gradient for gradient in sim.backward(dcost_dvs)]
+
+        candidates = numpy.clip(numpy.array(sim.Ps) + LINE_SEARCH_ALPHAS[:, None] * numpy.array(steps), 0, max_power)
+
+        # Forward to get average (depends on time for each segment)
+        candidates, _, _, _, average_powers = sim.forward_batch(candidates, params, initial_velocity=initial_velocity,
+                                                                solver=solver, solver_params=solver_params)
+
+        # Rescale average
+        candidates *= (average_power / average_powers)[:, None]
+
+        # Reforward to recompute velocity
+        candidates, _, _, total_times, _ = sim.forward_batch(candidates, params, initial_velocity=initial_velocity,
+                                                             solver=solver, solver_params=solver_params)
+
+        best_powers = candidates[numpy.argmin(total_times)].tolist()
+
+        # Update internal state of sim...
+        sim.forward(best_powers, params=params, solver=solver, solver_params=solver_params,
+                    initial_velocity=initial_velocity, compute_sensitivities=True)
+        forward_passes += 2 * len(LINE_SEARCH_ALPHAS) + 1
+
+        if abs(sim.get_total_time() - last_time) < time_tolerance \
+                and sim.get_average_power() < average_power + power_tolerance:
+            break
+        else:
+            last_time = sim.get_total_time()
+            if callback is not None:
+                callback(iterations, last_time)
+
+    return iterations, forward_passes
+
+
+def optimize_quasi_newton(sim: Simulation.Simulation, params: dict, average_power: float, max_power: float,
+                          initial_velocity: float, solver, solver_params: dict, method="SLSQP", max_iterations=100,
+                          power_tolerance=5, time_tolerance=0.5, equality=True, initial_Ps=None, terminal_distance=None,
+                          callback=None):
+    # Minimizes the time with the powers bounded by [0, max_power] and a constraint on the average power (W / T), either
+    # with SLSQP or with L-BFGS-B on an augmented lagrangian. The time and the constraint are differentiated with the
+    # adjoint pass of the simulation. Starts at initial_Ps or at constant power, sim is left at the optimized powers.
+    # Returns the number of iterations and forward passes.
+    import scipy.optimize
+
+    cost_ds = get_cost_ds(sim.ds, terminal_distance)
+    ds = numpy.asarray(sim.ds, dtype=float)
+    # The constraint W - P_avg T is divided by the time at constant power, so that it is in watts
+    constraint_scale = None
+    state = {"x": None, "forward_passes": 0}
+
+    def evaluate(x):
+        # Objective, constraint and their gradients for x, the last evaluation is reused as scipy asks for the
+        # function values and the gradients separately
+        if state["x"] is not None and numpy.array_equal(x, state["x"]):
+            return state
+        sim.forward(x.tolist(), params=params, initial_velocity=initial_velocity, solver=solver,
+                    solver_params=solver_params, compute_sensitivities=True)
+        state["forward_passes"] += 1
+
+        vs = numpy.array(sim.vs)
+        ts = numpy.array(sim.ts)
+        Ps = numpy.array(sim.Ps)
+        state["x"] = x.copy()
+        state["cost"] = get_total_cost(sim, cost_ds)
+        state["cost_gradient"] = numpy.array(sim.backward(Simulation.Simulation.get_time_jacobian(vs, cost_ds)))
+
+        # c = sum_t (P_t - P_avg) d_t / v_t
+        state["constraint"] = (Ps - average_power) @ ts / constraint_scale
+        dconstraint_dvs = numpy.append(-(Ps - average_power) * ds / vs[:-1] ** 2, 0)
+        state["constraint_gradient"] = numpy.array(sim.backward(dconstraint_dvs, ts)) / constraint_scale
+        return state
+
+    sim.forward([average_power] * len(ds), params=params, initial_velocity=initial_velocity, solver=solver,
+                solver_params=solver_params)
+    constraint_scale = sim.get_total_time()
+    x0 = get_initial_powers(sim, average_power, max_power, initial_Ps)
+    state["forward_passes"] += 1
+
+    iterations = 0
+
+    def iteration_callback(x, *_):
+        nonlocal iterations
+        iterations += 1
+        if callback is not None:
+            callback(iterations, evaluate(x)["cost"] - cost_ds[-1] / sim.vs[-1])
+
+    if method.upper() == "SLSQP":
+        # The optimization variables are the powers relative to the average power, with the identity as initial
+        # hessian the first steps are otherwise too small to change the time. SLSQP expects constraints as c(x) = 0 or
+        # c(x) >= 0, i.e. P_avg T - W >= 0 for the inequality.
+        constraint = {"type": "eq" if equality else "ineq",
+                      "fun": lambda u: -evaluate(u * average_power)["constraint"],
+                      "jac": lambda u: -evaluate(u * average_power)["constraint_gradient"] * average_power}
+        result = scipy.optimize.minimize(lambda u: evaluate(u * average_power)["cost"], x0 / average_power,
+                                         jac=lambda u: evaluate(u * average_power)["cost_gradient"] * average_power,
+                                         method="SLSQP", bounds=[(0, max_power / average_power)] * len(ds),
+                                         constraints=[constraint],
+                                         callback=lambda u: iteration_callback(u * average_power),
+                                         options={"maxiter": max_iterations, "ftol": time_tolerance / 10})
+        x = result.x * average_power
+    elif method.upper() == "L-BFGS-B":
+        # Augmented lagrangian, the multiplier is updated after every inner minimization and the penalty is increased
+        # if the constraint violation did not decrease enough
+        multiplier = 0.0
+        penalty = 1.0
+        last_violation = numpy.inf
+        x = x0
+        if initial_Ps is not None:
+            # A warm start is close to the optimum, the multiplier is estimated from the stationarity of the lagrangian
+            # (cost gradient + multiplier * constraint gradient = 0) on the powers that are not at a bound. Otherwise
+            # the first minimization without the constraint moves far away from the warm start.
+            values = evaluate(x)
+            free = (x > 0) & (x < max_power)
+            constraint_gradient = values["constraint_gradient"][free]
+            if constraint_gradient @ constraint_gradient > 0:
+                multiplier = -(values["cost_gradient"][free] @ constraint_gradient) \
+                             / (constraint_gradient @ constraint_gradient)
+                if not equality:
+                    multiplier = max(0.0, multiplier)
+
+        def get_lagrangian(x):
+            values = evaluate(x)
+            if equality:
+                shifted = values["constraint"]
+                derivative = multiplier + penalty * shifted
+                value = multiplier * shifted + penalty / 2 * shifted ** 2
+            else:
+                shifted = max(0.0, values["constraint"] + multiplier / penalty)
+                derivative = penalty * shifted
+                value = penalty / 2 * shifted ** 2 - multiplier ** 2 / (2 * penalty)
+            return values["cost"] + value, values["cost_gradient"] + derivative * values["constraint_gradient"]
+
+        def get_scaled_lagrangian(u):
+            # The optimization variables are the powers relative to the average power (as for SLSQP), otherwise the
+            # first steps are too small to change the time and the minimization stops
+            value, gradient = get_lagrangian(u * average_power)
+            return value, gradient * average_power
+
+        last_cost = numpy.inf
+        while iterations < max_iterations:
+            # ftol of L-BFGS-B is relative to the value of the objective
+            result = scipy.optimize.minimize(get_scaled_lagrangian, x / average_power, jac=True, method="L-BFGS-B",
+                                             bounds=[(0, max_power / average_power)] * len(ds),
+                                             callback=lambda u: iteration_callback(u * average_power),
+                                             options={"maxiter": max_iterations - iterations,
+                                                      "ftol": time_tolerance / 10 / constraint_scale})
+            x = result.x * average_power
+            values = evaluate(x)
+            violation = abs(values["constraint"]) if equality else max(values["constraint"], 0)
+            if violation < power_tolerance and abs(values["cost"] - last_cost) < time_tolerance or result.nit == 0:
+                break
+            last_cost = values["cost"]
+
+            if equality:
+                multiplier += penalty * values["constraint"]
+            else:
+                multiplier = max(0.0, multiplier + penalty * values["constraint"])
+            if violation > last_violation / 4:
+                penalty *= 10
+            last_violation = violation
+    else:
+        raise ValueError(f"Unknown optimizer method: {method}")
+
+    evaluate(x)
+    return iterations, state["forward_passes"]
+
+
+def get_interpolation_weights(grid: numpy.ndarray, values: numpy.ndarray):
+    # Indices of the grid points left of the values and the weights of the right grid points, values outside of the grid
+    # are clamped to the grid
+    values = numpy.clip(values, grid[0], grid[-1])
+    indices = numpy.clip(numpy.searchsorted(grid, values, side="right") - 1, 0, len(grid) - 2)
+    weights = (values - grid[indices]) / (grid[indices + 1] - grid[indices])
+    return indices, weights
+
+
+def solve_dynamic_programming(sim: Simulation.Simulation, params: dict, multipliers: numpy.ndarray,
+                              velocity_grid: numpy.ndarray, power_grid: numpy.ndarray, solver, solver_params: dict):
+    # Backward pass of the dynamic program for the cost sum_t t_t + multiplier * P_t t_t (time plus the weighted work)
+    # and the terminal cost of get_cost_ds, for all multipliers at once. The value function is interpolated linearly
+    # between the velocities of the grid, velocities below the grid are not allowed. The transitions of a segment are
+    # computed when the segment is reached, only the current value function and the indices of the optimal powers
+    # (segments x multipliers x velocities) are kept.
+    cost_ds = get_cost_ds(sim.ds)
+    values = numpy.repeat((cost_ds[-1] / velocity_grid)[None, :], len(multipliers), axis=0)
+    policy = numpy.empty((len(sim.ds), len(multipliers), len(velocity_grid)),
+                         dtype=numpy.min_scalar_type(len(power_grid)))
+
+    last_velocities = numpy.repeat(velocity_grid[:, None], len(power_grid), axis=1)
+    Ps = numpy.repeat(power_grid[None, :], len(velocity_grid), axis=0)
+    for t in reversed(range(len(sim.ds))):
+        velocities = Simulation.Simulation.get_velocities(last_velocities, Ps, d=sim.ds[t], delta_h=sim.delta_hs[t],
+                                                          Psi=sim.Psis[t], params=params, solver=solver,
+                                                          solver_params=solver_params)
+        infeasible = numpy.isnan(velocities) | (velocities < velocity_grid[0])
+        indices, weights = get_interpolation_weights(velocity_grid, numpy.where(infeasible, velocity_grid[0],
+                                                                                velocities))
+        next_values = values[:, indices] * (1 - weights) + values[:, indices + 1] * weights
+
+        segment_times = sim.ds[t] / velocity_grid
+        costs = segment_times[None, :, None] * (1 + multipliers[:, None, None] * power_grid[None, None, :]) \
+                + numpy.where(infeasible, numpy.inf, next_values)
+
+        policy[t] = costs.argmin(axis=2)
+        values = numpy.take_along_axis(costs, policy[t][:, :, None].astype(int), axis=2)[:, :, 0]
+
+    return policy
+
+
+def get_plans(sim: Simulation.Simulation, params: dict, policy: numpy.ndarray, velocity_grid: numpy.ndarray,
+              power_grid: numpy.ndarray, initial_velocity: float, solver, solver_params: dict):
+    # Simulates the policies of solve_dynamic_programming, the power between two velocities of the grid is interpolated
+    # linearly. Like forward the power is increased if a segment is not feasible. Returns the powers (multipliers x
+    # segments), the total times and the average powers.
+    num_plans = policy.shape[1]
+    Ps = numpy.empty((num_plans, len(sim.ds)))
+    velocities = numpy.full(num_plans, float(initial_velocity))
+    ts = numpy.empty((num_plans, len(sim.ds)))
+    plans = numpy.arange(num_plans)
+
+    for t in range(len(sim.ds)):
+        indices, weights = get_interpolation_weights(velocity_grid, velocities)
+        Ps[:, t] = power_grid[policy[t, plans, indices]] * (1 - weights) \
+                   + power_grid[policy[t, plans, indices + 1]] * weights
+        Ps[:, t], next_velocities = Simulation.Simulation.get_feasible_powers(velocities, Ps[:, t], d=sim.ds[t],
+                                                                              delta_h=sim.delta_hs[t],
+                                                                              Psi=sim.Psis[t], params=params,
+                                                                              solver=solver,
+                                                                              solver_params=solver_params)
+        ts[:, t] = sim.ds[t] / velocities
+        velocities = next_velocities
+
+    total_times = ts.sum(axis=1)
+    return Ps, total_times, (Ps * ts).sum(axis=1) / total_times
+
+
+def optimize_dynamic_programming(sim: Simulation.Simulation, params: dict, average_power: float, max_power: float,
+                                 initial_velocity: float, solver, solver_params: dict, max_iterations=10,
+                                 power_tolerance=5, num_velocities=100, num_powers=50, num_multipliers=8,
+                                 callback=None):
+    # Dynamic programming over a grid of velocities and powers, the work is added to the time with a lagrange
+    # multiplier. The multiplier is searched on a logarithmic scale, every iteration solves the dynamic program for
+    # num_multipliers multipliers in the current bracket at once. The grid of velocities covers the velocities at
+    # constant power with a margin. sim is left at the fastest plan below the average power (plus power_tolerance).
+    # Returns the number of iterations and forward passes.
+    sim.forward([average_power] * len(sim.ds), params=params, initial_velocity=initial_velocity, solver=solver,
+                solver_params=solver_params)
+    forward_passes = 1
+    velocity_grid = numpy.linspace(min(sim.vs) / 2, max(sim.vs) * 1.5, num_velocities)
+    power_grid = numpy.linspace(0, max_power, num_powers)
+
+    # Multiplier in s/J, a faster plan with more work is only chosen if it saves more than multiplier seconds per joule
+    lower_exponent = -7
+    upper_exponent = 0
+    best_Ps = numpy.array(sim.Ps, dtype=float)
+    best_time = numpy.inf
+
+    iterations = 0
+    for iterations in range(1, max_iterations + 1):
+        multipliers = numpy.logspace(lower_exponent, upper_exponent, num_multipliers)
+        policy = solve_dynamic_programming(sim, params, multipliers, velocity_grid, power_grid, solver, solver_params)
+        Ps, total_times, average_powers = get_plans(sim, params, policy, velocity_grid, power_grid, initial_velocity,
+                                                    solver, solver_params)
+        forward_passes += num_multipliers
+
+        feasible = average_powers < average_power + power_tolerance
+        if feasible.any() and total_times[feasible].min() < best_time:
+            best = numpy.flatnonzero(feasible)[total_times[feasible].argmin()]
+            best_Ps = Ps[best]
+            best_time = total_times[best]
+            if callback is not None:
+                callback(iterations, best_time)
+
+        # The average power decreases with the multiplier, the bracket is narrowed to the neighbours of the target. If
+        # all plans are on one side of the target, the bracket is moved by DYNAMIC_PROGRAMMING_EXPANSION_DECADES instead
+        exponents = numpy.log10(multipliers)
+        above = numpy.flatnonzero(average_powers > average_power)
+        below = numpy.flatnonzero(average_powers <= average_power)
+        if len(below) == 0:
+            lower_exponent = upper_exponent
+            upper_exponent += DYNAMIC_PROGRAMMING_EXPANSION_DECADES
+        elif len(above) == 0:
+            upper_exponent = lower_exponent
+            lower_exponent -= DYNAMIC_PROGRAMMING_EXPANSION_DECADES
+        else:
+            lower_exponent = exponents[above.max()]
+            upper_exponent = exponents[below.min()]
+
+        if feasible.any() and abs(average_powers[feasible].max() - average_power) < power_tolerance:
+            break
+
+    sim.forward(best_Ps.tolist(), params=params, initial_velocity=initial_velocity, solver=solver,
+                solver_params=solver_params)
+    forward_passes += 1
+
+    return iterations, forward_passes
+
+
+def get_multigrid_segment_lens(coarse_segment_len: float, segment_len: float):
+    # Segment lengths from coarse_segment_len down to segment_len, spaced geometrically with a ratio of at most
+    # MULTIGRID_REFINEMENT between two levels
+    if coarse_segment_len <= segment_len:
+        return [segment_len]
+    num_levels = math.ceil(math.log(coarse_segment_len / segment_len) / math.log(MULTIGRID_REFINEMENT))
+    return [coarse_segment_len * (segment_len / coarse_segment_len) ** (level / num_levels)
+            for level in range(num_levels)] + [segment_len]
+
+
+def optimize_multigrid(courses: list, optimize, max_iterations=100, polish_iterations=10, callback=None):
+    # Coarse to fine optimization: courses are the (ds, delta_hs, Psis) of the same route from the coarsest to the
+    # finest segmentation. The coarsest level is optimized with up to max_iterations, every finer level starts at the
+    # result of the previous level (prolonged with RouteNormalization.resample) and is only polished with up to
+    # polish_iterations. optimize(sim, max_iterations, initial_Ps) runs one of the optimizers and returns the number of
+    # iterations and forward passes, callback(level, sim) is called after every level.
+    # Returns the simulation of the finest level and the total number of iterations and forward passes.
+    sim = None
+    iterations = 0
+    forward_passes = 0
+    for level, (ds, delta_hs, Psis) in enumerate(courses):
+        initial_Ps = None
+        if sim is not None:
+            initial_Ps = RouteNormalization.resample(sim.ds, sim.Ps, ds)
+        sim = Simulation.Simulation(ds, delta_hs, Psis)
+        level_iterations, level_forward_passes = optimize(sim, max_iterations if level == 0 else polish_iterations,
+                                                          initial_Ps)
+        iterations += level_iterations
+        forward_passes += level_forward_passes
+        if callback is not None:
+            callback(level, sim)
+
+    return sim, iterations, forward_passes
+
+
+def get_budget_power(average_power: float, elapsed_time: float, elapsed_work: float, remaining_time: float):
+    # Average power for the rest of the course such that the average power of the whole course is average_power: the
+    # work that is left over (or overspent) so far is spread over the (estimated) remaining time
+    return average_power + (average_power * elapsed_time - elapsed_work) / remaining_time
+
+
+def get_terminal_distance(velocity: float, P: float, d: float, delta_h: float, Psi: float, params: dict,
+                          remaining_distance: float):
+    # Terminal cost of a window that does not end at the end of the course. Linearizing dv/ds = a(v, P) / v around the
+    # velocity, a change of the velocity at the end of the window decays over the distance l = -1 / (d(a/v)/dv) and
+    # saves l / v^2 seconds per m/s, i.e. the terminal cost is l / v_N. Limited to the remaining distance.
+    acceleration = Simulation.Simulation.get_acceleration(velocity, P, d, delta_h, Psi, params)
+    da_dv, _ = Simulation.Simulation.get_acceleration_derivatives(velocity, P, d, delta_h, Psi, params)
+    derivative = (da_dv * velocity - acceleration) / velocity ** 2
+    if derivative >= 0:
+        return remaining_distance
+    return min(-1 / derivative, remaining_distance)
+
+
+def optimize_receding_horizon(sim: Simulation.Simulation, params: dict, average_power: float, max_power: float,
+                              initial_velocity: float, solver, solver_params: dict, optimize, window=200, commit=None,
+                              max_iterations=100, polish_iterations=10, elapsed_time=0, elapsed_work=0,
+                              callback=None):
+    # Receding horizon: optimizes a window of segments, commits the first commit segments (half of the window by
+    # default) and shifts the window, so the cost grows linearly with the length of the course. Every window after the
+    # first starts at the plan of the previous window and runs at most polish_iterations. The average power of a window
+    # is the work budget (see get_budget_power) with the remaining time estimated at constant power, elapsed_time and
+    # elapsed_work are the time and work before the start of sim (to re-plan during a ride).
+    # optimize(sim, max_iterations, initial_Ps, average_power, initial_velocity, terminal_distance) runs one of the
+    # optimizers and returns the number of iterations and forward passes, callback(segment, elapsed_time) is called
+    # after every window. sim is left at the committed plan. Returns the number of iterations and forward passes.
+    if commit is None:
+        commit = max(window // 2, 1)
+    assert 0 < commit <= window
+    num_segments = len(sim.ds)
+
+    # Estimate of the remaining time for the work budget
+    sim.forward([average_power] * num_segments, params=params, initial_velocity=initial_velocity, solver=solver,
+                solver_params=solver_params)
+    remaining_times = sim.get_total_time() - sim.cumulative_ts
+    forward_passes = 1
+    iterations = 0
+
+    plan = numpy.empty(num_segments)
+    velocity = initial_velocity
+    initial_Ps = None
+    start = 0
+    while start < num_segments:
+        end = min(start + window, num_segments)
+        window_sim = Simulation.Simulation(sim.ds[start:end], sim.delta_hs[start:end], sim.Psis[start:end])
+        window_power = numpy.clip(get_budget_power(average_power, elapsed_time, elapsed_work, remaining_times[start]),
+                                  0, max_power)
+
+        terminal_distance = None
+        if end < num_segments:
+            end_velocity = velocity
+            if initial_Ps is not None:
+                # End velocity of the warm start
+                window_sim.forward(initial_Ps.tolist(), params=params, initial_velocity=velocity, solver=solver,
+                                   solver_params=solver_params)
+                end_velocity = window_sim.vs[-1]
+                forward_passes += 1
+            terminal_distance = get_terminal_distance(end_velocity, window_power, sim.ds[end], sim.delta_hs[end],
+                                                      sim.Psis[end], params, sim.get_total_distance()
+                                                      - sim.cumulative_ds[end])
+
+        window_iterations, window_forward_passes = optimize(
+            window_sim, max_iterations if initial_Ps is None else polish_iterations, initial_Ps, window_power, velocity,
+            terminal_distance)
+        iterations += window_iterations
+        forward_passes += window_forward_passes
+
+        committed = commit if end < num_segments else end - start
+        plan[start:start + committed] = window_sim.requested_Ps[:committed]
+        velocity = window_sim.vs[committed]
+        elapsed_time += window_sim.cumulative_ts[committed]
+        elapsed_work += window_sim.cumulative_works[committed]
+        if callback is not None:
+            callback(start + committed, elapsed_time)
+
+        # Warm start of the next window: the rest of this window and the budget power for the new segments
+        initial_Ps = numpy.append(window_sim.requested_Ps[committed:],
+                                  numpy.full(min(end + commit, num_segments) - end, window_power))
+        start += committed
+
+    sim.forward(plan.tolist(), params=params, initial_velocity=initial_velocity, solver=solver,
+                solver_params=solver_params)
+    forward_passes += 1
+    return iterations, forward_passes
@@ -3,7 +3,10 @@ import math
 
 
 def read_params(fname):
-    root = json.load(open(fname, "r"))
+    return get_params(json.load(open(fname, "r")))
+
+
+def get_params(root: dict):
     fields = ["CdA", "Crr", "m", "g"]
     ret = dict()
     for field in fields:
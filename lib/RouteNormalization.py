@@ -1,42 +1,132 @@
-def normalize(ds: list, delta_hs: list, Psis: list, segment_len=10):
+import math
+
+import numpy
+
+# Growth of the length of merged segments with the distance from the last change of the gradient or heading
+SIMPLIFY_GROWTH = 2
+
+
+def _interpolate_cumulative(xs: numpy.ndarray, values: numpy.ndarray, positions: numpy.ndarray):
+    # Evaluates the piecewise linear cumulative sum of values (with breakpoints xs) at the given positions
+    ds = numpy.diff(xs)
+    indices = numpy.clip(numpy.searchsorted(xs, positions, side="right") - 1, 0, len(ds) - 1)
+    fractions = numpy.divide(positions - xs[indices], ds[indices], out=numpy.zeros(len(positions)),
+                             where=ds[indices] > 0)
+    cumulative = numpy.concatenate(([0], numpy.cumsum(values)))
+    return cumulative[indices] + fractions * values[indices]
+
+
+def normalize(ds, delta_hs, Psis, segment_len=10, circular_mean_heading=False):
+    # Cuts the route into segments of segment_len (the last segment contains the remainder), the heading of a segment
+    # is either the heading at the end of the segment or the distance weighted circular mean over the segment.
+    assert len(ds) == len(delta_hs)
+    ds = numpy.asarray(ds, dtype=float)
+    delta_hs = numpy.asarray(delta_hs, dtype=float)
+    Psis = numpy.asarray(Psis, dtype=float)
+
+    xs = numpy.concatenate(([0], numpy.cumsum(ds)))
+    total_distance = xs[-1]
+
+    new_xs = numpy.arange(math.floor(total_distance / segment_len) + 1) * segment_len
+    if total_distance - new_xs[-1] > 1e-6:
+        new_xs = numpy.append(new_xs, total_distance)
+
+    new_ds = numpy.diff(new_xs)
+    new_delta_hs = numpy.diff(_interpolate_cumulative(xs, delta_hs, new_xs))
+
+    if circular_mean_heading:
+        sin_sums = numpy.diff(_interpolate_cumulative(xs, ds * numpy.sin(Psis), new_xs))
+        cos_sums = numpy.diff(_interpolate_cumulative(xs, ds * numpy.cos(Psis), new_xs))
+        new_Psis = numpy.arctan2(sin_sums, cos_sums) % (2 * math.pi)
+    else:
+        # Heading of the part of the route in which the segment ends
+        indices = numpy.clip(numpy.searchsorted(xs, new_xs[1:], side="left") - 1, 0, len(ds) - 1)
+        new_Psis = Psis[indices]
+
+    return new_ds, new_delta_hs, new_Psis
+
+
+def resample(ds, values, new_ds):
+    # Transfers values that are constant over every segment of ds (e.g. the power) to the segments new_ds of the same
+    # route: every new segment gets the distance weighted mean of the values it overlaps
+    ds = numpy.asarray(ds, dtype=float)
+    values = numpy.asarray(values, dtype=float)
+    new_ds = numpy.asarray(new_ds, dtype=float)
+
+    xs = numpy.concatenate(([0], numpy.cumsum(ds)))
+    new_xs = numpy.clip(numpy.concatenate(([0], numpy.cumsum(new_ds))), 0, xs[-1])
+    integrals = numpy.diff(_interpolate_cumulative(xs, values * ds, new_xs))
+    lengths = numpy.diff(new_xs)
+    # Segments beyond the end of the route (rounding of the total distance) get the last value
+    return numpy.divide(integrals, lengths, out=numpy.full(len(new_ds), values[-1]), where=lengths > 0)
+
+
+def _douglas_peucker(xs: numpy.ndarray, hs: numpy.ndarray, tolerance: float):
+    # Marks the points of the elevation profile that are kept such that the profile interpolated linearly between
+    # them deviates at most tolerance (vertically) from all points
+    keep = numpy.zeros(len(xs), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(xs) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        chord = hs[first] + (hs[last] - hs[first]) * (xs[first + 1:last] - xs[first]) / (xs[last] - xs[first])
+        deviations = numpy.abs(hs[first + 1:last] - chord)
+        worst = int(numpy.argmax(deviations))
+        if deviations[worst] > tolerance:
+            middle = first + 1 + worst
+            keep[middle] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return keep
+
+
+def simplify(ds, delta_hs, Psis, elevation_tolerance=None, gradient_tolerance=None, heading_tolerance=None,
+             max_segment_len=None):
+    # Merges consecutive segments between changes of the gradient or heading. The gradient changes at the vertices of
+    # the Douglas-Peucker simplification (with elevation_tolerance in m) of the elevation profile at which it changes
+    # by more than gradient_tolerance, the heading changes where it deviates by more than heading_tolerance (in rad)
+    # from the heading after the last change. A limit that is None is not checked (every vertex is a change if
+    # gradient_tolerance is None). Merged segments get the distance weighted circular mean of the headings.
     assert len(ds) == len(delta_hs)
-    new_ds = []
-    new_delta_hs = []
-    new_Psis = []
-
-    while len(ds) > 0:
-        new_d = 0
-        new_delta_h = 0
-
-        while len(ds) > 0:
-            d = ds.pop(0)
-            delta_h = delta_hs.pop(0)
-            Psi = Psis.pop(0)
-
-            if d + new_d >= segment_len:
-                required_dist = segment_len - new_d
-                required_factor = required_dist / d
-
-                new_d += d * required_factor
-                new_delta_h += delta_h * required_factor
-
-                d *= (1 - required_factor)
-                delta_h *= (1 - required_factor)
-
-                new_ds.append(new_d)
-                new_delta_hs.append(new_delta_h)
-                new_Psis.append(Psi)
-                ds = [d] + ds
-                delta_hs = [delta_h] + delta_hs
-                Psis = [Psi] + Psis
-                break
-            else:
-                new_d += d
-                new_delta_h += delta_h
-
-            if len(ds) == 0:
-                new_ds.append(new_d)
-                new_delta_hs.append(new_delta_h)
-                new_Psis.append(Psi)
+    ds = numpy.asarray(ds, dtype=float)
+    delta_hs = numpy.asarray(delta_hs, dtype=float)
+    Psis = numpy.asarray(Psis, dtype=float)
+
+    xs = numpy.concatenate(([0], numpy.cumsum(ds)))
+    changes = numpy.zeros(len(xs), dtype=bool)
+    changes[0] = changes[-1] = True
+    if elevation_tolerance is not None:
+        hs = numpy.concatenate(([0], numpy.cumsum(delta_hs)))
+        vertices = numpy.flatnonzero(_douglas_peucker(xs, hs, elevation_tolerance))
+        gradient_changes = numpy.abs(numpy.diff(numpy.diff(hs[vertices]) / numpy.diff(xs[vertices])))
+        changes[vertices[1:-1]] = gradient_tolerance is None or gradient_changes > gradient_tolerance
+    if heading_tolerance is not None:
+        heading = Psis[0]
+        for i in range(1, len(ds)):
+            if changes[i] or abs((Psis[i] - heading + math.pi) % (2 * math.pi) - math.pi) > heading_tolerance:
+                changes[i] = True
+                heading = Psis[i]
+
+    # The time of a segment is computed from the velocity at its start, thus the segments after a change (at which the
+    # velocity is far from the steady state) are kept short: the length of a merged segment is at most SIMPLIFY_GROWTH
+    # - 1 times its distance from the last change (but at least one segment).
+    starts = [0]
+    change_indices = numpy.flatnonzero(changes)
+    for last_change, next_change in zip(change_indices[:-1], change_indices[1:]):
+        start = last_change
+        for i in range(last_change + 1, next_change):
+            length = xs[i + 1] - xs[start]
+            if length > (SIMPLIFY_GROWTH - 1) * (xs[start] - xs[last_change]) \
+                    or (max_segment_len is not None and length > max_segment_len):
+                starts.append(i)
+                start = i
+        if next_change < len(ds):
+            starts.append(next_change)
 
+    new_ds = numpy.add.reduceat(ds, starts)
+    new_delta_hs = numpy.add.reduceat(delta_hs, starts)
+    new_Psis = numpy.arctan2(numpy.add.reduceat(ds * numpy.sin(Psis), starts),
+                             numpy.add.reduceat(ds * numpy.cos(Psis), starts)) % (2 * math.pi)
     return new_ds, new_delta_hs, new_Psis
@@ -2,6 +2,7 @@ import math
 from enum import Enum
 
 import matplotlib.pyplot as plt
+import numpy
 from .SympyMultiFunctions import sqrt, cos
 
 
@@ -9,19 +10,81 @@ class Solver(Enum):
     DIRECT_SHOOTING = 0,
     DISTANCE_EULER = 1
     TIME_EULER = 2
+    DISTANCE_RK45 = 3
+    TRANSITION_TABLE = 4
+
+
+# Butcher tableau of the Dormand-Prince method, the last stage is evaluated at the new state and is the first stage of
+# the next step. DORMAND_PRINCE_ERROR is the difference between the weights of the fifth and the fourth order solution.
+DORMAND_PRINCE_A = numpy.array([
+    [0, 0, 0, 0, 0, 0],
+    [1 / 5, 0, 0, 0, 0, 0],
+    [3 / 40, 9 / 40, 0, 0, 0, 0],
+    [44 / 45, -56 / 15, 32 / 9, 0, 0, 0],
+    [19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729, 0, 0],
+    [9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656, 0],
+])
+DORMAND_PRINCE_B = numpy.array([35 / 384, 0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84])
+DORMAND_PRINCE_ERROR = numpy.array([71 / 57600, 0, -71 / 16695, 71 / 1920, -17253 / 339200, 22 / 525, -1 / 40])
+
+# Steps smaller than this fraction of the segment are not feasible (overpower required)
+MIN_RK45_STEP_FRACTION = 1e-6
+
+# Segments that need more steps are not feasible, the equation gets stiff if the velocity approaches zero
+MAX_RK45_STEPS = 100
+
+# If a segment is not feasible with the requested power (overpower required) the power is increased to the minimum
+# power for which the velocity at the end of the segment is at least this velocity (in m/s)
+MIN_FEASIBLE_VELOCITY = 1
+
+# Accuracy (in W) of the minimum feasible power for the solvers for which it is not computed in closed form
+FEASIBLE_POWER_TOLERANCE = 1
+
+# The scalar search of the minimum feasible power (resimulate) stops once the velocity at the end of the segment is at
+# most this much (in m/s) above MIN_FEASIBLE_VELOCITY, or after MAX_FEASIBLE_POWER_ITERATIONS evaluations
+FEASIBLE_VELOCITY_TOLERANCE = 0.01
+MAX_FEASIBLE_POWER_ITERATIONS = 30
 
 
 class Simulation:
+    # The course and the state of the last forward pass are stored in contiguous float arrays. The cumulative distance,
+    # time and work (with a leading zero) are kept up to date by the forward pass, route queries are binary searches in
+    # these arrays.
+    __slots__ = ["ds", "delta_hs", "Psis", "cumulative_ds", "vertical_meters", "vs", "Ps", "ts", "dv_dvs", "dv_dPs",
+                 "forced_Ps", "evaluations", "cumulative_ts", "cumulative_works", "requested_Ps", "first_dirty",
+                 "forward_params", "forward_config"]
 
     def __init__(self, ds: list, delta_hs: list, Psis: list):
         assert len(ds) == len(delta_hs)
-        self.ds = ds
-        self.delta_hs = delta_hs
-        self.Psis = Psis
-
-        self.vs = []
-        self.Ps = []
-        self.ts = []
+        # Float arrays are not copied (e.g. a course in shared memory), the course is never modified
+        self.ds = numpy.asarray(ds, dtype=float)
+        self.delta_hs = numpy.asarray(delta_hs, dtype=float)
+        self.Psis = numpy.asarray(Psis, dtype=float)
+        self.cumulative_ds = numpy.concatenate([[0], numpy.cumsum(self.ds)])
+        self.vertical_meters = (float(numpy.maximum(self.delta_hs, 0).sum()),
+                                float(numpy.maximum(-self.delta_hs, 0).sum()))
+
+        num_segments = len(self.ds)
+        self.vs = numpy.full(num_segments + 1, numpy.nan)
+        self.Ps = numpy.full(num_segments, numpy.nan)
+        self.ts = numpy.full(num_segments, numpy.nan)
+        # Sensitivities of the velocity at the end of every segment, only set if the forward pass computes them
+        self.dv_dvs = numpy.full(num_segments, numpy.nan)
+        self.dv_dPs = numpy.full(num_segments, numpy.nan)
+        # Power that was added to every segment as the requested power is not feasible
+        self.forced_Ps = numpy.zeros(num_segments)
+        # Number of evaluations of the model for every segment
+        self.evaluations = numpy.zeros(num_segments, dtype=int)
+
+        self.cumulative_ts = numpy.zeros(num_segments + 1)
+        self.cumulative_works = numpy.zeros(num_segments + 1)
+
+        # State of the last forward pass for incremental re-simulation: the requested (not overpower adjusted) powers,
+        # the first segment that needs to be simulated again and the arguments of the last forward pass
+        self.requested_Ps = numpy.full(num_segments, numpy.nan)
+        self.first_dirty = 0
+        self.forward_params = None
+        self.forward_config = None
 
     @staticmethod
     def get_acceleration(v, P, d: float, delta_h: float, Psi: float, params: dict):
@@ -40,6 +103,38 @@ class Simulation:
                - g * (delta_h / d + Crr) \
                - 1 / (2 * m) * rho * CdA * (v - effective_wind_speed) ** 3 / v
 
+    @staticmethod
+    def get_acceleration_derivatives(v, P, d: float, delta_h: float, Psi: float, params: dict):
+        # Partial derivatives of get_acceleration with respect to v and P
+        rho = params["rho"]
+        CdA = params["CdA"]
+        m = params["m"]
+        omega = params["omega"]
+        v_w = params["v_w"]
+        effective_wind_speed = cos(omega - Psi) * v_w
+
+        da_dv = - P / (m * v ** 2) \
+                - 1 / (2 * m) * rho * CdA * (3 * (v - effective_wind_speed) ** 2 / v
+                                             - (v - effective_wind_speed) ** 3 / v ** 2)
+        da_dP = 1 / (m * v)
+
+        return da_dv, da_dP
+
+    @staticmethod
+    def get_velocity_jacobians(last_velocities, Ps, ds, delta_hs, Psis, params: dict):
+        # Derivatives of the DIRECT_SHOOTING step v_{t+1} = sqrt(v_t^2 + 2 d_t a_t) with respect to v_t and P_t,
+        # all arguments can be arrays over the segments
+        acceleration = Simulation.get_acceleration(last_velocities, Ps, ds, delta_hs, Psis, params)
+        da_dv, da_dP = Simulation.get_acceleration_derivatives(last_velocities, Ps, ds, delta_hs, Psis, params)
+        velocities = sqrt(last_velocities ** 2 + 2 * ds * acceleration)
+
+        return (last_velocities + ds * da_dv) / velocities, ds * da_dP / velocities
+
+    @staticmethod
+    def get_time_jacobian(velocities, ds):
+        # Derivative of the segment time t = d / v with respect to v
+        return -ds / velocities ** 2
+
     @staticmethod
     def get_time_for_distance_with_linear_acceleration(v_0, a, s):
         if a != 0:
@@ -66,32 +161,68 @@ class Simulation:
 
     @staticmethod
     def get_velocity(last_velocity, P, d: float, delta_h: float, Psi: float, params: dict,
-                     solver=Solver.DIRECT_SHOOTING, solver_params=None):
+                     solver=Solver.DIRECT_SHOOTING, solver_params=None, return_sensitivities=False, stats=None):
+        # If return_sensitivities is set the derivatives of the new velocity with respect to last_velocity and P
+        # are returned as well, these are accumulated over all steps taken by the solver. If stats is set the number of
+        # evaluations of the model is added to stats["evaluations"].
         if solver == Solver.DIRECT_SHOOTING:
             acceleration = Simulation.get_acceleration(last_velocity, P, d, delta_h, Psi, params)
-            return last_velocity + acceleration * Simulation.get_time_for_distance_with_linear_acceleration(
+            if stats is not None:
+                stats["evaluations"] = stats.get("evaluations", 0) + 1
+            velocity = last_velocity + acceleration * Simulation.get_time_for_distance_with_linear_acceleration(
                 last_velocity,
                 acceleration, d)
+
+            if return_sensitivities:
+                dv_dv, dv_dP = Simulation.get_velocity_jacobians(last_velocity, P, d, delta_h, Psi, params)
+                return velocity, dv_dv, dv_dP
+            return velocity
         elif solver == Solver.DISTANCE_EULER:
             distance_euler_step_size = solver_params["distance_euler_step_size"]
             num_steps = math.ceil(d / distance_euler_step_size)
+            if stats is not None:
+                stats["evaluations"] = stats.get("evaluations", 0) + num_steps
             velocity = last_velocity
+            dv_dv = 1
+            dv_dP = 0
+            # Steps of fixed length are unstable at low velocities (the velocity oscillates), thus the segment is not
+            # feasible if the velocity falls below MIN_FEASIBLE_VELOCITY (or the entry velocity if it is lower)
+            min_velocity = min(MIN_FEASIBLE_VELOCITY, last_velocity)
             for i in range(num_steps):
                 step_size = min(distance_euler_step_size, d - i * distance_euler_step_size)
                 acceleration = Simulation.get_acceleration(velocity, P, step_size, delta_h * (step_size / d), Psi,
                                                            params)
-                velocity += acceleration * Simulation.get_time_for_distance_with_linear_acceleration(velocity,
-                                                                                                     acceleration,
-                                                                                                     step_size)
+                new_velocity = velocity + acceleration * Simulation.get_time_for_distance_with_linear_acceleration(
+                    velocity,
+                    acceleration,
+                    step_size)
+
+                if return_sensitivities:
+                    # Every step is v_{i+1} = sqrt(v_i^2 + 2 s a(v_i, P))
+                    da_dv, da_dP = Simulation.get_acceleration_derivatives(velocity, P, step_size,
+                                                                           delta_h * (step_size / d), Psi, params)
+                    step_dv_dv = (velocity + step_size * da_dv) / new_velocity
+                    dv_dP = step_dv_dv * dv_dP + step_size * da_dP / new_velocity
+                    dv_dv *= step_dv_dv
+
+                velocity = new_velocity
+                if velocity < min_velocity:
+                    raise ValueError("Overpower required!")
 
+            if return_sensitivities:
+                return velocity, dv_dv, dv_dP
             return velocity
         elif solver == Solver.TIME_EULER:
             time_euler_step_size = solver_params["time_euler_step_size"]
             min_time_euler_step_size = solver_params["min_time_euler_step_size"]
             distance = 0
             velocity = last_velocity
+            dv_dv = 1
+            dv_dP = 0
             while distance < d:
                 acceleration = Simulation.get_acceleration(velocity, P, d, delta_h, Psi, params)
+                if stats is not None:
+                    stats["evaluations"] = stats.get("evaluations", 0) + 1
                 new_distance = distance + velocity * time_euler_step_size + .5 * acceleration * time_euler_step_size ** 2
                 new_velocity = velocity + acceleration * time_euler_step_size
 
@@ -99,6 +230,13 @@ class Simulation:
                     raise ValueError("Overpower required!")
 
                 if new_distance <= d:
+                    if return_sensitivities:
+                        # Every accepted step is v_{i+1} = v_i + a(v_i, P) * dt
+                        da_dv, da_dP = Simulation.get_acceleration_derivatives(velocity, P, d, delta_h, Psi, params)
+                        step_dv_dv = 1 + da_dv * time_euler_step_size
+                        dv_dP = step_dv_dv * dv_dP + da_dP * time_euler_step_size
+                        dv_dv *= step_dv_dv
+
                     velocity = new_velocity
                     distance = new_distance
                 else:
@@ -106,58 +244,464 @@ class Simulation:
                     if time_euler_step_size < min_time_euler_step_size:
                         break
 
+            if return_sensitivities:
+                return velocity, dv_dv, dv_dP
             return velocity
+        elif solver == Solver.DISTANCE_RK45:
+            return Simulation.get_velocity_rk45(last_velocity, P, d, delta_h, Psi, params,
+                                                solver_params["rk_tolerance"],
+                                                return_sensitivities=return_sensitivities, stats=stats)
+        elif solver == Solver.TRANSITION_TABLE:
+            # solver_params["transition_table"] is a TransitionTable.TransitionTable
+            return solver_params["transition_table"].get_velocity(last_velocity, P, d, delta_h, Psi, params,
+                                                                  return_sensitivities=return_sensitivities,
+                                                                  stats=stats)
         else:
             raise Exception("Unknown solver!")
 
-    def forward(self, Ps: list, params: dict, initial_velocity=5, solver=Solver.DIRECT_SHOOTING, solver_params=None):
-        assert len(Ps) == len(self.ds)
-        self.Ps = Ps
-        self.vs = [initial_velocity]
-        self.ts = []
+    @staticmethod
+    def get_velocity_rk45(last_velocity, P, d: float, delta_h: float, Psi: float, params: dict, tolerance: float,
+                          return_sensitivities=False, stats=None):
+        # Integrates y = v^2 over the distance with dy/ds = 2 a(v, P) (DISTANCE_EULER takes euler steps of this
+        # equation) with the embedded Runge-Kutta method of Dormand and Prince. The step size is chosen such that the
+        # estimated error of the velocity is below tolerance for every step. The sensitivities dy/dy_0 and dy/dP are
+        # integrated alongside with the same steps (variational equations).
+        def get_derivative(state):
+            y, dy_dy0, dy_dP = state
+            if not y > 0:
+                return numpy.full(3, numpy.nan)
+            v = math.sqrt(y)
+            dy_ds = 2 * Simulation.get_acceleration(v, P, d, delta_h, Psi, params)
+            if not return_sensitivities:
+                return numpy.array([dy_ds, 0, 0])
+            da_dv, da_dP = Simulation.get_acceleration_derivatives(v, P, d, delta_h, Psi, params)
+            # d(dy/ds)/dy = 2 da/dv * dv/dy = da/dv / v
+            return numpy.array([dy_ds, da_dv / v * dy_dy0, da_dv / v * dy_dP + 2 * da_dP])
+
+        state = numpy.array([last_velocity ** 2, 1.0, 0.0])
+        derivative = get_derivative(state)
+        evaluations = 1
+        distance = 0
+        # The first step changes y by at most 20%
+        step_size = min(d, 0.2 * state[0] / max(abs(derivative[0]), 1e-300))
+        stages = numpy.empty((7, 3))
+        steps = 0
+        # A remainder below the minimum step is negligible
+        while distance < d * (1 - MIN_RK45_STEP_FRACTION):
+            step_size = min(step_size, d - distance)
+            steps += 1
+            # Only a decelerating rider can stall, while accelerating from a low velocity the steps are small but grow
+            if (step_size < MIN_RK45_STEP_FRACTION * d and derivative[0] < 0) or steps > MAX_RK45_STEPS:
+                raise ValueError("Overpower required!")
+
+            stages[0] = derivative
+            for i in range(1, 6):
+                stages[i] = get_derivative(state + step_size * (DORMAND_PRINCE_A[i, :i] @ stages[:i]))
+            new_state = state + step_size * (DORMAND_PRINCE_B @ stages[:6])
+            stages[6] = get_derivative(new_state)
+            evaluations += 6
+
+            velocity_error = abs(step_size * (DORMAND_PRINCE_ERROR @ stages[:, 0])) / (2 * math.sqrt(new_state[0])) \
+                if new_state[0] > 0 else numpy.nan
+
+            if velocity_error <= tolerance:
+                distance += step_size
+                state = new_state
+                derivative = stages[6].copy()
+                step_size *= min(5.0, 0.9 * (tolerance / max(velocity_error, 1e-300)) ** 0.2)
+            elif numpy.isnan(velocity_error):
+                step_size /= 4
+            else:
+                step_size *= max(0.2, 0.9 * (tolerance / velocity_error) ** 0.2)
 
-        for i in range(len(self.Ps)):
+        if stats is not None:
+            stats["evaluations"] = stats.get("evaluations", 0) + evaluations
+
+        velocity = math.sqrt(state[0])
+        if return_sensitivities:
+            # v = sqrt(y), y_0 = v_0^2
+            return velocity, state[1] * last_velocity / velocity, state[2] / (2 * velocity)
+        return velocity
+
+    @staticmethod
+    def get_velocities(last_velocities: numpy.ndarray, Ps: numpy.ndarray, d: float, delta_h: float, Psi: float,
+                       params: dict, solver=Solver.DIRECT_SHOOTING, solver_params=None):
+        # Vectorized version of get_velocity: steps all candidates through one segment at once,
+        # candidates for which the segment is not feasible (overpower required) get a velocity of nan
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            if solver == Solver.DIRECT_SHOOTING:
+                acceleration = Simulation.get_acceleration(last_velocities, Ps, d, delta_h, Psi, params)
+                # Same as v_0 + a * get_time_for_distance_with_linear_acceleration(v_0, a, s)
+                velocities = numpy.sqrt(last_velocities ** 2 + 2 * d * acceleration)
+            elif solver == Solver.DISTANCE_EULER:
+                distance_euler_step_size = solver_params["distance_euler_step_size"]
+                num_steps = math.ceil(d / distance_euler_step_size)
+                velocities = numpy.array(last_velocities, dtype=float)
+                # Same minimum velocity as in get_velocity, nan propagates through the remaining steps
+                min_velocities = numpy.minimum(MIN_FEASIBLE_VELOCITY, velocities)
+                for i in range(num_steps):
+                    step_size = min(distance_euler_step_size, d - i * distance_euler_step_size)
+                    acceleration = Simulation.get_acceleration(velocities, Ps, step_size, delta_h * (step_size / d),
+                                                               Psi, params)
+                    velocities = numpy.sqrt(velocities ** 2 + 2 * step_size * acceleration)
+                    velocities = numpy.where(velocities >= min_velocities, velocities, numpy.nan)
+            elif solver == Solver.TIME_EULER:
+                velocities = numpy.array(last_velocities, dtype=float)
+                time_euler_step_sizes = numpy.full(velocities.shape, solver_params["time_euler_step_size"])
+                min_time_euler_step_size = solver_params["min_time_euler_step_size"]
+                distances = numpy.zeros(velocities.shape)
+                feasible = numpy.ones(velocities.shape, dtype=bool)
+                stopped = numpy.zeros(velocities.shape, dtype=bool)
+                while True:
+                    active = feasible & ~stopped & (distances < d)
+                    if not active.any():
+                        break
+
+                    acceleration = Simulation.get_acceleration(velocities, Ps, d, delta_h, Psi, params)
+                    new_distances = distances + velocities * time_euler_step_sizes \
+                                    + .5 * acceleration * time_euler_step_sizes ** 2
+                    new_velocities = velocities + acceleration * time_euler_step_sizes
+
+                    feasible &= ~(active & (new_velocities <= 0))
+                    accept = active & feasible & (new_distances <= d)
+                    reject = active & feasible & ~(new_distances <= d)
+
+                    velocities = numpy.where(accept, new_velocities, velocities)
+                    distances = numpy.where(accept, new_distances, distances)
+                    time_euler_step_sizes = numpy.where(reject, time_euler_step_sizes / 2, time_euler_step_sizes)
+                    stopped |= reject & (time_euler_step_sizes < min_time_euler_step_size)
+
+                velocities = numpy.where(feasible, velocities, numpy.nan)
+            elif solver == Solver.DISTANCE_RK45:
+                velocities = Simulation.get_velocities_rk45(last_velocities, Ps, d, delta_h, Psi, params,
+                                                            solver_params["rk_tolerance"])
+            elif solver == Solver.TRANSITION_TABLE:
+                velocities = solver_params["transition_table"].get_velocities(last_velocities, Ps, d, delta_h, Psi,
+                                                                              params)
+            else:
+                raise Exception("Unknown solver!")
+
+        return numpy.where(numpy.isfinite(velocities) & (velocities > 0), velocities, numpy.nan)
+
+    @staticmethod
+    def get_velocities_rk45(last_velocities: numpy.ndarray, Ps: numpy.ndarray, d: float, delta_h: float, Psi: float,
+                            params: dict, tolerance: float):
+        # Vectorized version of get_velocity_rk45 (without sensitivities), every candidate has its own step size.
+        # Candidates for which the segment is not feasible get a velocity of nan.
+        def get_derivative(ys):
+            return 2 * Simulation.get_acceleration(numpy.sqrt(ys), Ps, d, delta_h, Psi, params)
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            ys = numpy.array(numpy.broadcast_to(numpy.asarray(last_velocities, dtype=float) ** 2,
+                                                numpy.broadcast(last_velocities, Ps).shape))
+            derivatives = get_derivative(ys)
+            distances = numpy.zeros(ys.shape)
+            step_sizes = numpy.minimum(d, 0.2 * ys / numpy.abs(derivatives))
+            feasible = (ys > 0) & numpy.isfinite(derivatives)
+            stages = numpy.empty((7,) + ys.shape)
+
+            for _ in range(MAX_RK45_STEPS):
+                active = feasible & (distances < d * (1 - MIN_RK45_STEP_FRACTION))
+                step_sizes = numpy.minimum(step_sizes, d - distances)
+                feasible &= ~(active & (step_sizes < MIN_RK45_STEP_FRACTION * d) & (derivatives < 0))
+                active &= feasible
+                if not active.any():
+                    break
+
+                stages[0] = derivatives
+                for i in range(1, 6):
+                    stages[i] = get_derivative(ys + step_sizes * numpy.tensordot(DORMAND_PRINCE_A[i, :i], stages[:i],
+                                                                                 axes=1))
+                new_ys = ys + step_sizes * numpy.tensordot(DORMAND_PRINCE_B, stages[:6], axes=1)
+                stages[6] = get_derivative(new_ys)
+                velocity_errors = numpy.abs(step_sizes * numpy.tensordot(DORMAND_PRINCE_ERROR, stages, axes=1)) \
+                    / (2 * numpy.sqrt(new_ys))
+
+                accept = active & (velocity_errors <= tolerance)
+                failed = active & numpy.isnan(velocity_errors)
+                factors = 0.9 * (tolerance / numpy.maximum(velocity_errors, 1e-300)) ** 0.2
+                factors = numpy.where(accept, numpy.minimum(5.0, factors), numpy.maximum(0.2, factors))
+                factors = numpy.where(failed, 0.25, factors)
+
+                ys = numpy.where(accept, new_ys, ys)
+                derivatives = numpy.where(accept, stages[6], derivatives)
+                distances = numpy.where(accept, distances + step_sizes, distances)
+                step_sizes = numpy.where(active, step_sizes * factors, step_sizes)
+
+            feasible &= distances >= d * (1 - MIN_RK45_STEP_FRACTION)
+            return numpy.where(feasible, numpy.sqrt(ys), numpy.nan)
+
+    @staticmethod
+    def get_feasible_powers(last_velocities: numpy.ndarray, Ps: numpy.ndarray, d: float, delta_h: float, Psi: float,
+                            params: dict, solver=Solver.DIRECT_SHOOTING, solver_params=None):
+        # Increases the power of all candidates for which the segment is not feasible (overpower required) to the power
+        # that reaches MIN_FEASIBLE_VELOCITY at the end of the segment. Returns the powers and the velocities at the end
+        # of the segment (as get_velocities).
+        last_velocities = numpy.asarray(last_velocities, dtype=float)
+        Ps = numpy.array(Ps, dtype=float)
+        velocities = Simulation.get_velocities(last_velocities, Ps, d, delta_h, Psi, params, solver, solver_params)
+        infeasible = numpy.isnan(velocities)
+        if not infeasible.any():
+            return Ps, velocities
+
+        # DIRECT_SHOOTING is feasible if v_0^2 + 2 d a(v_0, P) >= 0, the acceleration is P / (m v_0) plus the
+        # acceleration without power, thus v_0^2 + 2 d a(v_0, P) = v_min^2 can be solved for P
+        unpowered_accelerations = Simulation.get_acceleration(last_velocities, 0, d, delta_h, Psi, params)
+        closed_form_Ps = params["m"] * last_velocities \
+            * ((MIN_FEASIBLE_VELOCITY ** 2 - last_velocities ** 2) / (2 * d) - unpowered_accelerations)
+        if solver == Solver.DIRECT_SHOOTING:
+            Ps = numpy.where(infeasible, numpy.maximum(Ps, closed_form_Ps), Ps)
+            return Ps, Simulation.get_velocities(last_velocities, Ps, d, delta_h, Psi, params, solver, solver_params)
+
+        # The solution of the differential equation does not fall below the velocity at which the acceleration is zero,
+        # thus the power that holds v_min on the segment, P = -m v_min a(v_min, 0), is sufficient for DISTANCE_RK45 and
+        # TRANSITION_TABLE. For the euler solvers this is only the first guess for the upper bound of a bracket, which
+        # is extended by doubling the added power until the segment is feasible and then bisected to the tolerance.
+        steady_state_Ps = -params["m"] * MIN_FEASIBLE_VELOCITY \
+            * Simulation.get_acceleration(MIN_FEASIBLE_VELOCITY, 0, d, delta_h, Psi, params)
+
+        def get_velocities(powers):
+            return Simulation.get_velocities(last_velocities, powers, d, delta_h, Psi, params, solver, solver_params)
+
+        lower = Ps
+        upper = numpy.where(infeasible, numpy.maximum(steady_state_Ps, Ps + FEASIBLE_POWER_TOLERANCE), Ps)
+        upper_velocities = numpy.where(infeasible, get_velocities(upper), velocities)
+        searching = numpy.isnan(upper_velocities)
+        while searching.any():
+            lower = numpy.where(searching, upper, lower)
+            upper = numpy.where(searching, Ps + 2 * (upper - Ps), upper)
+            upper_velocities = numpy.where(searching, get_velocities(upper), upper_velocities)
+            searching &= numpy.isnan(upper_velocities)
+            if not numpy.isfinite(upper[searching]).all():
+                raise ValueError("No feasible power found!")
+
+        if solver in (Solver.DISTANCE_EULER, Solver.TIME_EULER):
+            searching = infeasible & (upper - lower > FEASIBLE_POWER_TOLERANCE)
+            while searching.any():
+                middle = (lower + upper) / 2
+                middle_velocities = get_velocities(middle)
+                feasible = searching & (middle_velocities >= MIN_FEASIBLE_VELOCITY)
+                upper = numpy.where(feasible, middle, upper)
+                upper_velocities = numpy.where(feasible, middle_velocities, upper_velocities)
+                lower = numpy.where(searching & ~feasible, middle, lower)
+                searching &= upper - lower > FEASIBLE_POWER_TOLERANCE
+
+        return upper, upper_velocities
+
+    @staticmethod
+    def get_feasible_power(last_velocity: float, P: float, d: float, delta_h: float, Psi: float, params: dict,
+                           solver=Solver.DIRECT_SHOOTING, solver_params=None, return_sensitivities=False,
+                           stats=None):
+        # Scalar version of get_feasible_powers for a segment that is not feasible with P, returns the power for which
+        # get_velocity with the same solver succeeds and the result of get_velocity for it. The search starts at the
+        # closed form (DIRECT_SHOOTING) or the steady state power and takes Newton steps on v^2 - v_min^2 (which is
+        # almost linear in the power), steps out of the bracket or into infeasible powers are replaced by bisection.
+        # The sensitivities are those of the forced segment: the velocity at the end does not depend on P (which is
+        # replaced) and, if the segment ends at MIN_FEASIBLE_VELOCITY, neither on the entry velocity. The partial
+        # derivatives at the forced power are not used, they diverge as the velocity approaches zero.
+        unpowered_acceleration = Simulation.get_acceleration(last_velocity, 0, d, delta_h, Psi, params)
+        closed_form_P = params["m"] * last_velocity \
+            * ((MIN_FEASIBLE_VELOCITY ** 2 - last_velocity ** 2) / (2 * d) - unpowered_acceleration)
+        if solver == Solver.DIRECT_SHOOTING:
+            P = max(P, closed_form_P)
+            velocity = Simulation.get_velocity(last_velocity, P, d, delta_h, Psi, params, solver, solver_params,
+                                               stats=stats)
+            return P, (velocity, 0, 0) if return_sensitivities else velocity
+        steady_state_P = -params["m"] * MIN_FEASIBLE_VELOCITY \
+            * Simulation.get_acceleration(MIN_FEASIBLE_VELOCITY, 0, d, delta_h, Psi, params)
+
+        def evaluate(power):
+            # v^2 - v_min^2, its derivative with respect to the power and the result of get_velocity, None if the
+            # segment is not feasible
+            try:
+                velocity, dv_dv, dv_dP = Simulation.get_velocity(last_velocity, power, d, delta_h, Psi, params, solver,
+                                                                 solver_params, return_sensitivities=True, stats=stats)
+            except ValueError:
+                return None
+            if not math.isfinite(velocity) or not velocity > 0:
+                return None
+            return velocity ** 2 - MIN_FEASIBLE_VELOCITY ** 2, 2 * velocity * dv_dP, \
+                (velocity, dv_dv if solver not in (Solver.DISTANCE_EULER, Solver.TIME_EULER) else 0, 0) \
+                if return_sensitivities else velocity
+
+        # As in get_feasible_powers the steady state power is sufficient for DISTANCE_RK45 and TRANSITION_TABLE, the
+        # euler solvers need at least MIN_FEASIBLE_VELOCITY at the end of the segment
+        def is_feasible(result):
+            if result is None:
+                return False
+            return result[0] >= 0 or solver not in (Solver.DISTANCE_EULER, Solver.TIME_EULER)
+
+        lower = P
+        upper = max(P + FEASIBLE_POWER_TOLERANCE,
+                    steady_state_P if solver not in (Solver.DISTANCE_EULER, Solver.TIME_EULER) else closed_form_P)
+        result = evaluate(upper)
+        while not is_feasible(result):
+            lower = upper
+            upper = P + 2 * (upper - P)
+            if not math.isfinite(upper):
+                raise ValueError("No feasible power found!")
+            result = evaluate(upper)
+        if solver not in (Solver.DISTANCE_EULER, Solver.TIME_EULER):
+            return upper, result[2]
+
+        bisect = False
+        for _ in range(MAX_FEASIBLE_POWER_ITERATIONS):
+            squared_velocity_excess, derivative, _ = result
+            if squared_velocity_excess <= (MIN_FEASIBLE_VELOCITY + FEASIBLE_VELOCITY_TOLERANCE) ** 2 \
+                    - MIN_FEASIBLE_VELOCITY ** 2 or upper - lower <= FEASIBLE_POWER_TOLERANCE:
+                break
+            candidate = (lower + upper) / 2
+            if derivative > 0 and not bisect and lower < upper - squared_velocity_excess / derivative < upper:
+                candidate = upper - squared_velocity_excess / derivative
+            candidate_result = evaluate(candidate)
+            # After a step into infeasible powers the next step bisects, Newton steps from above overshoot the same
+            # way again if v^2 is concave in the power
+            bisect = not is_feasible(candidate_result)
+            if bisect:
+                lower = candidate
+            else:
+                upper, result = candidate, candidate_result
+        return upper, result[2]
+
+    def forward(self, Ps: list, params: dict, initial_velocity=5, solver=Solver.DIRECT_SHOOTING, solver_params=None,
+                compute_sensitivities=False):
+        # If the arguments are the same as in the last forward pass only the segments from the first changed power on
+        # are simulated again, the entry velocities of the segments before are kept
+        assert len(Ps) == len(self.ds)
+        config = (initial_velocity, solver, dict(solver_params) if solver_params is not None else None,
+                  compute_sensitivities)
+        if self.forward_config == config and self.has_same_params(params):
+            changed = numpy.flatnonzero(numpy.asarray(Ps, dtype=float) != self.requested_Ps)
+            if len(changed) > 0:
+                self.first_dirty = min(self.first_dirty, changed[0])
+        else:
+            self.first_dirty = 0
+
+        self.forward_params = dict(params)
+        self.forward_config = config
+        self.requested_Ps = numpy.array(Ps, dtype=float)
+        self.resimulate()
+
+    def has_same_params(self, params: dict):
+        if self.forward_params is None or self.forward_params.keys() != params.keys():
+            return False
+        return all(numpy.array_equal(value, self.forward_params[key]) for key, value in params.items())
+
+    def set_power(self, index: int, P: float):
+        # Changes the power of one segment, the change is simulated by the next call of resimulate
+        self.requested_Ps[index] = P
+        self.first_dirty = min(self.first_dirty, index)
+
+    def resimulate(self):
+        # Simulates all segments starting at the first changed one with the arguments of the last forward pass
+        assert self.forward_config is not None, "resimulate requires a forward pass"
+        initial_velocity, solver, solver_params, compute_sensitivities = self.forward_config
+        params = self.forward_params
+        start = self.first_dirty
+
+        if start == 0:
+            self.vs[0] = initial_velocity
+        # The loop works on python floats, which is faster than numpy scalars
+        last_velocity = float(self.vs[start])
+        cumulative_t = float(self.cumulative_ts[start])
+        cumulative_work = float(self.cumulative_works[start])
+
+        for i in range(start, len(self.ds)):
+            delta_h = float(self.delta_hs[i])
+            d = float(self.ds[i])
+            P = float(self.requested_Ps[i])
+            Psi = float(self.Psis[i])
+
+            stats = {"evaluations": 0}
+            try:
+                v = self.get_velocity(last_velocity=last_velocity, P=P, d=d, delta_h=delta_h, Psi=Psi, params=params,
+                                      solver=solver, solver_params=solver_params,
+                                      return_sensitivities=compute_sensitivities, stats=stats)
+            except ValueError:
+                # Overpower required, the power is searched with the same (scalar) solver so that it is feasible
+                P, v = self.get_feasible_power(last_velocity, P, d=d, delta_h=delta_h, Psi=Psi, params=params,
+                                               solver=solver, solver_params=solver_params,
+                                               return_sensitivities=compute_sensitivities, stats=stats)
+                P = float(P)
+
+            if compute_sensitivities:
+                v, self.dv_dvs[i], self.dv_dPs[i] = v
+            else:
+                self.dv_dvs[i] = self.dv_dPs[i] = numpy.nan
+
+            t = d / last_velocity
+            cumulative_t += t
+            cumulative_work += P * t
+
+            self.vs[i + 1] = v
+            self.Ps[i] = P
+            self.forced_Ps[i] = P - self.requested_Ps[i]
+            self.ts[i] = t
+            self.evaluations[i] = stats["evaluations"]
+            self.cumulative_ts[i + 1] = cumulative_t
+            self.cumulative_works[i + 1] = cumulative_work
+            last_velocity = v
+
+        self.first_dirty = len(self.ds)
+
+    def get_forced_segments(self):
+        # Segments of the last forward pass for which the power had to be increased and the power that was added
+        return [(int(i), float(self.forced_Ps[i])) for i in numpy.flatnonzero(self.forced_Ps > 0)]
+
+    def backward(self, dcost_dvs, dcost_dPs=None):
+        # Adjoint pass for a cost sum_t c_t(v_t, P_t) over the trajectory of the last forward pass (which needs to be
+        # run with compute_sensitivities), dcost_dvs contains the derivative for all velocities including the final
+        # one. Returns the derivative of the cost with respect to every power.
+        assert self.forward_config is not None and self.forward_config[3] and len(dcost_dvs) == len(self.ds) + 1
+
+        dv_dvs = self.dv_dvs.tolist()
+        dv_dPs = self.dv_dPs.tolist()
+        gradient = [0] * len(self.ds)
+        adjoint = dcost_dvs[-1]
+        for t in reversed(range(len(self.ds))):
+            gradient[t] = adjoint * dv_dPs[t]
+            if dcost_dPs is not None:
+                gradient[t] += dcost_dPs[t]
+            adjoint = dcost_dvs[t] + adjoint * dv_dvs[t]
+
+        return gradient
+
+    def forward_batch(self, Ps: numpy.ndarray, params: dict, initial_velocity=5, solver=Solver.DIRECT_SHOOTING,
+                      solver_params=None):
+        # Simulates K power profiles (K x N array) at once, does not change the state of the simulation.
+        # Returns the (overpower adjusted) powers, velocities, segment times, total times and average powers.
+        Ps = numpy.array(Ps, dtype=float)
+        assert Ps.ndim == 2 and Ps.shape[1] == len(self.ds)
+        num_candidates, num_segments = Ps.shape
+
+        vs = numpy.empty((num_candidates, num_segments + 1))
+        vs[:, 0] = initial_velocity
+        ts = numpy.empty((num_candidates, num_segments))
+
+        for i in range(num_segments):
             delta_h = self.delta_hs[i]
             d = self.ds[i]
-            P = self.Ps[i]
             Psi = self.Psis[i]
 
-            while True:
-                try:
-                    v = self.get_velocity(last_velocity=self.vs[-1], P=P, d=d, delta_h=delta_h, Psi=Psi, params=params,
-                                          solver=solver, solver_params=solver_params)
-                except ValueError:
-                    # Overpower required
-                    self.Ps[i] += 10
-                    P = self.Ps[i]
-                    continue
-                break
+            Ps[:, i], v = self.get_feasible_powers(vs[:, i], Ps[:, i], d=d, delta_h=delta_h, Psi=Psi, params=params,
+                                                   solver=solver, solver_params=solver_params)
 
-            t = d / self.vs[-1]
+            ts[:, i] = d / vs[:, i]
+            vs[:, i + 1] = v
 
-            self.vs.append(v)
-            self.ts.append(t)
+        total_times = ts.sum(axis=1)
+        average_powers = (Ps * ts).sum(axis=1) / total_times
 
-    def get_total_time(self):
-        total_time = 0
-        for t in self.ts:
-            total_time += t
+        return Ps, vs, ts, total_times, average_powers
 
-        return total_time
+    def get_total_time(self):
+        return float(self.cumulative_ts[-1])
 
     def get_total_distance(self):
-        total_distance = 0
-        for d in self.ds:
-            total_distance += d
-
-        return total_distance
+        return float(self.cumulative_ds[-1])
 
     def get_total_work(self):
-        work = 0
-        for P, t in zip(self.Ps, self.ts):
-            work += P * t
-
-        return work
+        return float(self.cumulative_works[-1])
 
     def get_average_speed(self):
         return self.get_total_distance() / self.get_total_time()
@@ -166,21 +710,25 @@ class Simulation:
         return self.get_total_work() / self.get_total_time()
 
     def get_vertical_meters(self):
-        vert_pos = 0
-        vert_neg = 0
-        for delta_h in self.delta_hs:
-            if delta_h > 0:
-                vert_pos += delta_h
-            else:
-                vert_neg -= delta_h
+        return self.vertical_meters
+
+    def get_time_at_distance(self, distance):
+        # Time (in s) at which the distance (in m, a number or an array) is reached in the last forward pass. The
+        # velocity is constant within a segment (t = d / v), thus the time is linear between the segment boundaries and
+        # numpy.interp (a binary search in the cumulative distances) is exact. Distances outside the course are clipped.
+        return numpy.interp(distance, self.cumulative_ds, self.cumulative_ts)
+
+    def get_distance_at_time(self, time):
+        # Inverse of get_time_at_distance
+        return numpy.interp(time, self.cumulative_ts, self.cumulative_ds)
 
-        return vert_pos, vert_neg
+    def get_split_times(self, distances):
+        # Times between consecutive distances (in m), e.g. kilometre markers
+        return numpy.diff(self.get_time_at_distance(distances))
 
     def plot(self, show_speed=False, show_power=False, show_elevation=False,
              show_average_power=False, title=None):
-        xs = [0]
-        for x in self.ds:
-            xs.append(xs[-1] + x / 1000)
+        xs = self.cumulative_ds / 1000
 
         fig, ax1 = plt.subplots(dpi=200)
         ax2 = ax1.twinx()
@@ -191,8 +739,7 @@ class Simulation:
         assert show_speed or show_power
 
         if show_speed:
-            vs_kmh = [v * 3.6 for v in self.vs]
-            ax1.plot(xs, vs_kmh, color="green")
+            ax1.plot(xs, self.vs * 3.6, color="green")
             ax1.set_ylabel("Speed (km/h)", color="green")
 
         if show_power:
@@ -202,19 +749,17 @@ class Simulation:
                 ax2.plot(xs[1:], [self.get_average_power()] * (len(xs) - 1), color="red", linestyle="dotted")
 
         if show_elevation:
-            hs = [0]
-            for delta_h in self.delta_hs:
-                hs.append(hs[-1] + delta_h)
+            hs = numpy.concatenate([[0], numpy.cumsum(self.delta_hs)])
 
             ax = ax1 if not show_speed else ax2
 
             if show_speed and show_power:
                 min_y, max_y = ax.get_ylim()
 
-                min_h = min(hs)
-                max_h = max(hs)
+                min_h = hs.min()
+                max_h = hs.max()
 
-                hs = [(h - min_h) / (max_h - min_h) * (max_y - min_y) + min_y for h in hs]
+                hs = (hs - min_h) / (max_h - min_h) * (max_y - min_y) + min_y
             else:
                 ax.set_ylabel("Relative Altitude (m)")
 
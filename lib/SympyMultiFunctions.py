@@ -1,10 +1,14 @@
 import sympy
 import math
 
+import numpy
+
 
 def sqrt(x):
     if isinstance(x, sympy.Expr):
         return sympy.sqrt(x)
+    elif isinstance(x, numpy.ndarray):
+        return numpy.sqrt(x)
     else:
         return math.sqrt(x)
 
@@ -12,5 +16,7 @@ def sqrt(x):
 def cos(x):
     if isinstance(x, sympy.Expr):
         return sympy.cos(x)
+    elif isinstance(x, numpy.ndarray):
+        return numpy.cos(x)
     else:
         return math.cos(x)
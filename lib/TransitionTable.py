@@ -0,0 +1,298 @@
+import bisect
+import itertools
+import math
+
+import numpy
+
+from . import ArrayCache, Simulation
+
+# Default grids (start, stop, number of values) of the entry velocity (m/s), the power (W), the gradient and the
+# effective wind speed (m/s, cos(omega - Psi) * v_w)
+VELOCITY_GRID = (0.5, 30, 60)
+POWER_GRID = (0, 1000, 41)
+GRADIENT_GRID = (-0.25, 0.25, 51)
+WIND_GRID = (-15, 15, 31)
+
+# Velocity tolerance of the integrator (DISTANCE_RK45) that fills the table and evaluates queries outside of the table
+INTEGRATOR_TOLERANCE = 1e-4
+
+# Fields of the params the table depends on, the wind is one of the dimensions of the table
+PARAM_FIELDS = ["CdA", "Crr", "m", "g", "rho"]
+
+# Segment lengths closer than this are considered equal (m)
+DISTANCE_TOLERANCE = 1e-3
+
+# Maximum number of segment lengths in a table, the most frequent lengths of a course are used
+MAX_DISTANCES = 8
+
+# Number of random queries used to estimate the interpolation error of a new table
+ERROR_SAMPLES = 20000
+
+# Number of entries of the table that are integrated at once while building it
+BUILD_CHUNK_SIZE = 2 ** 18
+
+
+class TransitionTable:
+    # Exit velocity of a segment over a grid of (entry velocity, power, gradient, effective wind speed, segment length)
+    # for fixed params, computed with the DISTANCE_RK45 solver. Queries are answered by multilinear interpolation, the
+    # time of a segment (d / v_entry) does not need to be tabulated. Queries outside of the grid, for other params or
+    # next to infeasible entries of the table (nan) are answered by the integrator.
+    #
+    # The interpolation error of every dimension is bounded by h^2 / 8 * max |d^2 v_exit / dx^2| with the grid
+    # spacing h. As the second derivatives are not known in closed form, the error is estimated from random queries
+    # when the table is built (max_error and rms_error, in m/s).
+    def __init__(self, params: dict, axes: list, values: numpy.ndarray, max_error=numpy.nan, rms_error=numpy.nan):
+        self.params = {field: params[field] for field in PARAM_FIELDS}
+        self.axes = [numpy.asarray(axis, dtype=float) for axis in axes]
+        # A plain array instead of a memory map, indexing a memory map element-wise is slow
+        self.values = numpy.asarray(values, dtype=float).reshape([len(axis) for axis in self.axes])
+        self.flat_values = self.values.reshape(-1)
+        self.strides = [stride // self.values.itemsize for stride in self.values.strides]
+        # Python versions for interpolate_single
+        self.axis_lists = [axis.tolist() for axis in self.axes]
+        self.max_error = max_error
+        self.rms_error = rms_error
+        self.solver_params = {"rk_tolerance": INTEGRATOR_TOLERANCE}
+
+    @staticmethod
+    def get_axes(ds, velocity_grid=VELOCITY_GRID, power_grid=POWER_GRID, gradient_grid=GRADIENT_GRID,
+                 wind_grid=WIND_GRID):
+        # The segment lengths are the MAX_DISTANCES most frequent lengths of the segments ds
+        distances, counts = numpy.unique(numpy.round(numpy.asarray(ds, dtype=float), 3), return_counts=True)
+        distances = numpy.sort(distances[numpy.argsort(-counts, kind="stable")[:MAX_DISTANCES]])
+        return [numpy.linspace(*velocity_grid), numpy.linspace(*power_grid), numpy.linspace(*gradient_grid),
+                numpy.linspace(*wind_grid), distances]
+
+    @staticmethod
+    def integrate(last_velocities, Ps, gradients, winds, d: float, params: dict):
+        # Exit velocities of the integrator, the effective wind speed is passed as wind speed with the wind direction
+        # equal to the heading
+        return Simulation.Simulation.get_velocities(last_velocities, Ps, d=d, delta_h=gradients * d, Psi=0,
+                                                    params=dict(params, omega=0, v_w=winds),
+                                                    solver=Simulation.Solver.DISTANCE_RK45,
+                                                    solver_params={"rk_tolerance": INTEGRATOR_TOLERANCE})
+
+    @staticmethod
+    def build(params: dict, axes: list):
+        values = numpy.empty([len(axis) for axis in axes])
+        grid = [column.ravel() for column in numpy.meshgrid(*axes[:4], indexing="ij")]
+        for k, d in enumerate(axes[4]):
+            exit_velocities = numpy.empty(len(grid[0]))
+            for begin in range(0, len(exit_velocities), BUILD_CHUNK_SIZE):
+                chunk = slice(begin, begin + BUILD_CHUNK_SIZE)
+                exit_velocities[chunk] = TransitionTable.integrate(*[column[chunk] for column in grid], d, params)
+            values[..., k] = exit_velocities.reshape(values.shape[:4])
+
+        table = TransitionTable(params, axes, values)
+        table.estimate_error()
+        return table
+
+    def estimate_error(self, num_samples=ERROR_SAMPLES, seed=0):
+        # Compares the interpolation with the integrator for random queries within the grid
+        rng = numpy.random.default_rng(seed)
+        queries = [rng.uniform(axis[0], axis[-1], num_samples) for axis in self.axes[:4]]
+        distances = rng.choice(self.axes[4], num_samples)
+        interpolated = numpy.array([result[0] if result is not None else numpy.nan
+                                    for result in map(self.interpolate_single, zip(*queries, distances))])
+        exact = numpy.empty(num_samples)
+        for d in self.axes[4]:
+            selected = distances == d
+            exact[selected] = self.integrate(*[query[selected] for query in queries], d, self.params)
+
+        errors = numpy.abs(interpolated - exact)
+        errors = errors[numpy.isfinite(errors)]
+        self.max_error = errors.max() if len(errors) > 0 else numpy.nan
+        self.rms_error = numpy.sqrt(numpy.mean(errors ** 2)) if len(errors) > 0 else numpy.nan
+
+    def locate(self, dimension: int, value: float):
+        # Index of the lower grid point of the cell of value, index of the upper grid point, the weight of the upper
+        # grid point and the spacing, None if value is outside of the grid. The segment lengths are not interpolated,
+        # value needs to be one of them.
+        axis = self.axis_lists[dimension]
+        index = min(max(bisect.bisect_right(axis, value) - 1, 0), max(len(axis) - 2, 0))
+        upper = min(index + 1, len(axis) - 1)
+        if dimension == len(self.axes) - 1:
+            if abs(value - axis[index]) < DISTANCE_TOLERANCE:
+                return index, index, 0, 1
+            if abs(value - axis[upper]) < DISTANCE_TOLERANCE:
+                return upper, upper, 0, 1
+            return None
+        if not axis[0] <= value <= axis[-1]:
+            return None
+        if upper == index:
+            return index, index, 0, 1
+        spacing = axis[upper] - axis[index]
+        return index, upper, (value - axis[index]) / spacing, spacing
+
+    def get_segment_corners(self, gradient: float, wind: float, d: float):
+        # Indices (gradient, wind, segment length) and weights of the corners of the cell of a segment, these are the
+        # same for all queries of the segment. None if the segment is outside of the table.
+        cells = [self.locate(dimension, value) for dimension, value in ((2, gradient), (3, wind), (4, d))]
+        if None in cells:
+            return None
+        (gradient_index, gradient_upper, gradient_weight, _), (wind_index, wind_upper, wind_weight, _), \
+            (distance_index, _, _, _) = cells
+        return [(gradient_index, wind_index, distance_index, (1 - gradient_weight) * (1 - wind_weight)),
+                (gradient_upper, wind_index, distance_index, gradient_weight * (1 - wind_weight)),
+                (gradient_index, wind_upper, distance_index, (1 - gradient_weight) * wind_weight),
+                (gradient_upper, wind_upper, distance_index, gradient_weight * wind_weight)]
+
+    def interpolate(self, last_velocities, Ps, gradient: float, winds, d: float):
+        # Multilinear interpolation of the exit velocities of a segment. The table is interpolated over the gradient,
+        # the segment length and the wind (if it is the same for all queries) once, the queries are interpolated in the
+        # remaining (entry velocity, power and wind) table. Queries outside of the grid or with an infeasible neighbour
+        # are nan.
+        queries = [numpy.asarray(last_velocities, dtype=float), numpy.asarray(Ps, dtype=float)]
+        axes = self.axes[:2]
+        if numpy.ndim(winds) == 0:
+            corners = self.get_segment_corners(gradient, winds, d)
+            if corners is None:
+                return numpy.full(numpy.broadcast(*queries).shape, numpy.nan)
+            values = sum(weight * self.values[:, :, gradient_index, wind_index, distance_index]
+                         for gradient_index, wind_index, distance_index, weight in corners)
+        else:
+            gradient_cell = self.locate(2, gradient)
+            distance_cell = self.locate(4, d)
+            if gradient_cell is None or distance_cell is None:
+                return numpy.full(numpy.broadcast(*queries, winds).shape, numpy.nan)
+            gradient_index, gradient_upper, gradient_weight, _ = gradient_cell
+            distance_index = distance_cell[0]
+            values = (1 - gradient_weight) * self.values[:, :, gradient_index, :, distance_index] \
+                + gradient_weight * self.values[:, :, gradient_upper, :, distance_index]
+            queries.append(numpy.asarray(winds, dtype=float))
+            axes = self.axes[:2] + [self.axes[3]]
+        queries = numpy.broadcast_arrays(*queries)
+
+        indices = []
+        weights = []
+        inside = numpy.ones(queries[0].shape, dtype=bool)
+        for axis, query in zip(axes, queries):
+            index = numpy.clip(numpy.searchsorted(axis, query, side="right") - 1, 0, max(len(axis) - 2, 0))
+            upper = numpy.minimum(index + 1, len(axis) - 1)
+            spacing = numpy.where(upper > index, axis[upper] - axis[index], 1)
+            indices.append((index, upper))
+            weights.append(numpy.clip((query - axis[index]) / spacing, 0, 1))
+            inside &= (query >= axis[0]) & (query <= axis[-1])
+
+        velocities = 0
+        for corner in itertools.product((0, 1), repeat=len(axes)):
+            factor = 1
+            for weight, upper in zip(weights, corner):
+                factor = factor * (weight if upper else 1 - weight)
+            velocities = velocities + factor * values[tuple(pair[upper] for pair, upper in zip(indices, corner))]
+        return numpy.where(inside, velocities, numpy.nan)
+
+    def interpolate_single(self, query: tuple):
+        # Same as interpolate for a single query with python scalars (which is faster than numpy for single values),
+        # also returns the derivatives with respect to the entry velocity and the power. Returns None if the query can
+        # not be interpolated.
+        last_velocity, P, gradient, wind, d = query
+        corners = self.get_segment_corners(gradient, wind, d)
+        v_cell = self.locate(0, last_velocity)
+        P_cell = self.locate(1, P)
+        if corners is None or v_cell is None or P_cell is None:
+            return None
+        v_index, v_upper, v_weight, v_spacing = v_cell
+        P_index, P_upper, P_weight, P_spacing = P_cell
+
+        # Values at the four (entry velocity, power) corners, interpolated over the other dimensions
+        v_stride, P_stride, gradient_stride, wind_stride, distance_stride = self.strides
+        lower_lower = v_index * v_stride + P_index * P_stride
+        upper_lower = v_upper * v_stride + P_index * P_stride
+        lower_upper = v_index * v_stride + P_upper * P_stride
+        upper_upper = v_upper * v_stride + P_upper * P_stride
+        value_ll = value_ul = value_lu = value_uu = 0
+        for gradient_index, wind_index, distance_index, weight in corners:
+            offset = gradient_index * gradient_stride + wind_index * wind_stride + distance_index * distance_stride
+            value_ll += weight * float(self.flat_values[offset + lower_lower])
+            value_ul += weight * float(self.flat_values[offset + upper_lower])
+            value_lu += weight * float(self.flat_values[offset + lower_upper])
+            value_uu += weight * float(self.flat_values[offset + upper_upper])
+
+        velocity = (1 - v_weight) * ((1 - P_weight) * value_ll + P_weight * value_lu) \
+            + v_weight * ((1 - P_weight) * value_ul + P_weight * value_uu)
+        if math.isnan(velocity):
+            return None
+        dv_dv = ((1 - P_weight) * (value_ul - value_ll) + P_weight * (value_uu - value_lu)) / v_spacing
+        dv_dP = ((1 - v_weight) * (value_lu - value_ll) + v_weight * (value_uu - value_ul)) / P_spacing
+        return velocity, dv_dv, dv_dP
+
+    def has_params(self, params: dict):
+        return all(numpy.ndim(params[field]) == 0 and params[field] == value for field, value in self.params.items())
+
+    def get_velocities(self, last_velocities, Ps, d: float, delta_h: float, Psi: float, params: dict):
+        # Same as Simulation.get_velocities (nan if not feasible), queries that can not be interpolated are integrated
+        if not self.has_params(params):
+            return Simulation.Simulation.get_velocities(last_velocities, Ps, d, delta_h, Psi, params,
+                                                        solver=Simulation.Solver.DISTANCE_RK45,
+                                                        solver_params=self.solver_params)
+
+        last_velocities, Ps = numpy.broadcast_arrays(numpy.asarray(last_velocities, dtype=float),
+                                                     numpy.asarray(Ps, dtype=float))
+        wind = numpy.cos(params["omega"] - Psi) * params["v_w"]
+        velocities = self.interpolate(last_velocities, Ps, delta_h / d, wind, d)
+
+        missing = numpy.isnan(velocities) & numpy.isfinite(last_velocities)
+        if missing.any():
+            velocities[missing] = Simulation.Simulation.get_velocities(last_velocities[missing], Ps[missing], d,
+                                                                       delta_h, Psi, params,
+                                                                       solver=Simulation.Solver.DISTANCE_RK45,
+                                                                       solver_params=self.solver_params)
+        return velocities
+
+    def get_velocity(self, last_velocity, P, d: float, delta_h: float, Psi: float, params: dict,
+                     return_sensitivities=False, stats=None):
+        # Same as Simulation.get_velocity (raises a ValueError if not feasible)
+        if self.has_params(params):
+            wind = math.cos(params["omega"] - Psi) * params["v_w"]
+            result = self.interpolate_single((last_velocity, P, delta_h / d, wind, d))
+            if result is not None:
+                if return_sensitivities:
+                    return result
+                return result[0]
+
+        return Simulation.Simulation.get_velocity_rk45(last_velocity, P, d, delta_h, Psi, params, INTEGRATOR_TOLERANCE,
+                                                       return_sensitivities=return_sensitivities, stats=stats)
+
+
+def get_transition_table(params: dict, ds, use_cache=True, cache_dir=None,
+                         max_cache_size=ArrayCache.DEFAULT_MAX_SIZE):
+    # Loads the table for the params and the segment lengths of ds from the cache (memory mapped) or builds it
+    axes = TransitionTable.get_axes(ds)
+    if use_cache:
+        if cache_dir is None:
+            cache_dir = ArrayCache.get_default_cache_dir()
+        key_parts = ([float(params[field]) for field in PARAM_FIELDS], [axis.tolist() for axis in axes],
+                     INTEGRATOR_TOLERANCE)
+        key = ArrayCache.get_key("transition_table", *key_parts)
+        # The error estimate is a separate (small) entry, it is estimated again if only the table is in the cache
+        error_key = ArrayCache.get_key("transition_table_error", *key_parts)
+        cached = ArrayCache.lookup(cache_dir, key)
+        if cached is not None:
+            table = TransitionTable(params, axes, cached[0])
+            cached_errors = ArrayCache.lookup(cache_dir, error_key)
+            if cached_errors is not None:
+                table.max_error, table.rms_error = cached_errors[0]
+                return table
+            table.estimate_error()
+            ArrayCache.store(cache_dir, error_key, [[table.max_error, table.rms_error]], max_size=max_cache_size)
+            return table
+
+    table = TransitionTable.build(params, axes)
+
+    if use_cache:
+        ArrayCache.store(cache_dir, key, [table.values.ravel()], max_size=max_cache_size)
+        ArrayCache.store(cache_dir, error_key, [[table.max_error, table.rms_error]], max_size=max_cache_size)
+
+    return table
+
+
+def get_solver(solver, solver_params: dict, params: dict, ds, use_cache=True, cache_dir=None):
+    # Adds the transition table to the solver params if the TRANSITION_TABLE solver is selected. No table can be built
+    # for sampled params (arrays), these are simulated with the integrator instead.
+    if solver != Simulation.Solver.TRANSITION_TABLE:
+        return solver, solver_params
+    if any(numpy.ndim(params[field]) > 0 for field in PARAM_FIELDS):
+        return Simulation.Solver.DISTANCE_RK45, dict(solver_params, rk_tolerance=INTEGRATOR_TOLERANCE)
+    table = get_transition_table(params, ds, use_cache=use_cache, cache_dir=cache_dir)
+    return solver, dict(solver_params, transition_table=table)
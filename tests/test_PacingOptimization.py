@@ -0,0 +1,23 @@
+import numpy
+
+from lib import ParamReader, PacingOptimization
+from lib.Simulation import Simulation, Solver
+
+SOLVER_PARAMS = {"distance_euler_step_size": 1, "time_euler_step_size": 0.1, "min_time_euler_step_size": 0.01,
+                 "rk_tolerance": 0.001}
+
+
+def test_dynamic_programming_widens_the_multiplier_bracket():
+    # With this little resistance even the plan of the largest initial multiplier (1s/J) is above 1W, the bracket has
+    # to be moved to larger multipliers to reach the target
+    params = ParamReader.get_params({"temperature": 15, "pressure": 1013.25, "CdA": 0.01, "Crr": 0.001, "m": 71,
+                                     "g": 9.81})
+    sim = Simulation([100.0] * 20, [0.0] * 20, [0.0] * 20)
+    iterations, _ = PacingOptimization.optimize_dynamic_programming(sim, params, average_power=1, max_power=5,
+                                                                     initial_velocity=5, solver=Solver.DIRECT_SHOOTING,
+                                                                     solver_params=SOLVER_PARAMS,
+                                                                     power_tolerance=0.05)
+    assert iterations < 10
+    assert abs(sim.get_average_power() - 1) < 0.05
+    # Not the constant power of the initial forward pass
+    assert numpy.ptp(sim.Ps) > 0
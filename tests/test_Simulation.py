@@ -0,0 +1,35 @@
+import numpy
+
+from lib import ParamReader
+from lib.Simulation import Simulation, Solver, MIN_FEASIBLE_VELOCITY
+
+PARAMS = ParamReader.get_params({"temperature": 15, "pressure": 1013.25, "CdA": 0.23, "Crr": 0.002845, "m": 71,
+                                 "g": 9.81})
+SOLVER_PARAMS = {"distance_euler_step_size": 1, "time_euler_step_size": 0.1, "min_time_euler_step_size": 0.01,
+                 "rk_tolerance": 0.001}
+
+
+def test_forced_segments_at_low_entry_velocity():
+    # A 25% wall entered at 2m/s, 100W is not feasible on any of the segments
+    sim = Simulation([100.0] * 20, [25.0] * 20, [0.0] * 20)
+    for solver in (Solver.DIRECT_SHOOTING, Solver.DISTANCE_EULER, Solver.TIME_EULER, Solver.DISTANCE_RK45):
+        sim.forward([100.0] * 20, PARAMS, initial_velocity=2, solver=solver, solver_params=SOLVER_PARAMS,
+                    compute_sensitivities=True)
+        # TIME_EULER creeps up the wall (the velocity stays positive), the other solvers need more power
+        assert len(sim.get_forced_segments()) > 0 or solver == Solver.TIME_EULER
+        assert numpy.isfinite(sim.vs).all() and (sim.vs > 0).all()
+        assert (sim.Ps >= 100).all()
+        assert numpy.isfinite(sim.dv_dvs).all() and numpy.isfinite(sim.dv_dPs).all()
+
+
+def test_euler_feasible_power_is_feasible_for_both_integrators():
+    # The scalar and the vectorized DISTANCE_EULER solver agree on the feasibility of a segment, the forced power
+    # found by resimulate is feasible for both
+    sim = Simulation([100.0] * 20, [25.0] * 20, [0.0] * 20)
+    sim.forward([100.0] * 20, PARAMS, initial_velocity=2, solver=Solver.DISTANCE_EULER, solver_params=SOLVER_PARAMS)
+    for i, _ in sim.get_forced_segments():
+        velocities = Simulation.get_velocities(numpy.array([sim.vs[i]]), numpy.array([sim.Ps[i]]), sim.ds[i],
+                                               sim.delta_hs[i], sim.Psis[i], PARAMS, Solver.DISTANCE_EULER,
+                                               SOLVER_PARAMS)
+        assert velocities[0] >= MIN_FEASIBLE_VELOCITY
+        assert abs(velocities[0] - sim.vs[i + 1]) < 1e-9